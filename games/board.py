@@ -0,0 +1,323 @@
+import struct
+
+from games.layout import MineLayout
+
+MINE = 'M'
+EMPTY = 'E'
+HIDDEN = 'X'
+
+# In memory every cell is one byte: the low nibble keeps the adjacent mine count
+# and the high nibble keeps the mine and revealed flags
+COUNT_MASK = 0x0F
+DIGITS = '0123456789abcdef'
+MINE_FLAG = 0x10
+REVEALED_FLAG = 0x20
+
+PACK_VERSION = 1
+HEADER = struct.Struct('>BI')
+# Boards with mines derived from a seed only pack the seed, the mine count and the revealed bitmap
+SEEDED_PACK_VERSION = 2
+SEEDED_HEADER = struct.Struct('>BIQI')
+
+
+def _table(func):
+    return bytes(func(value) for value in range(256))
+
+
+def _symbol(value):
+    if value & MINE_FLAG:
+        return ord(MINE)
+    if value & REVEALED_FLAG:
+        return ord(DIGITS[value & COUNT_MASK])
+    return ord(EMPTY)
+
+
+def _player_symbol(value):
+    if value & REVEALED_FLAG and not value & MINE_FLAG:
+        return ord(DIGITS[value & COUNT_MASK])
+    return ord(HIDDEN)
+
+
+SYMBOL_TABLE = _table(_symbol)
+PLAYER_SYMBOL_TABLE = _table(_player_symbol)
+MINE_BIT_TABLE = _table(lambda value: ord('1') if value & MINE_FLAG else ord('0'))
+REVEALED_BIT_TABLE = _table(lambda value: ord('1') if value & REVEALED_FLAG else ord('0'))
+COUNT_HEX_TABLE = _table(lambda value: ord(DIGITS[value & COUNT_MASK]))
+MINE_BYTE_TABLE = _table(lambda value: 1 if value & MINE_FLAG else 0)
+FLAGS_TABLE = _table(lambda value: value & ~COUNT_MASK)
+PLAYER_HEX_TABLE = _table(lambda value: ord(DIGITS[value & COUNT_MASK]) if value & REVEALED_FLAG and not value & MINE_FLAG else ord('f'))
+SYMBOL_HEX_TABLE = _table(lambda value: ord('d') if value & MINE_FLAG else ord(DIGITS[value & COUNT_MASK]) if value & REVEALED_FLAG else ord('e'))
+BIT_BYTE_TABLE = _table(lambda value: 1 if value == ord('1') else 0)
+HEX_COUNT_TABLE = _table(lambda value: DIGITS.index(chr(value)) if chr(value) in DIGITS else 0)
+
+
+def _pack_bits(cells, table):
+    bits = cells.translate(table)
+    padding = -len(bits) % 8
+    bits += b'0' * padding
+    return int(bits, 2).to_bytes(len(bits) // 8, 'big') if bits else b''
+
+
+def _unpack_bits(data, length):
+    # Spread every bit into its own byte so flags can be merged without a python loop
+    bits = bin(int.from_bytes(data, 'big'))[2:].zfill(len(data) * 8)[:length]
+    return int.from_bytes(bits.encode().translate(BIT_BYTE_TABLE), 'big')
+
+
+def _rows(cells, width, table):
+    rendered = cells.translate(table).decode()
+    return [rendered[start:start + width] for start in range(0, len(rendered), width)]
+
+
+def _nibbles(cells, table):
+    cells = cells.translate(table)
+    if len(cells) % 2:
+        cells += b'f'
+    return bytes.fromhex(cells.decode())
+
+
+class Board:
+    """
+    Whole game map kept as a flat byte array, indexed by x * size + y.
+
+    Boards unpacked from a seeded pack keep their seed while that pack is what is stored, it is
+    cleared once they are packed whole
+    """
+
+    def __init__(self, size, cells=None, seed=None):
+        self.size = size
+        self.cells = cells if cells is not None else bytearray(size * size)
+        self.seed = seed
+
+    def index(self, x, y):
+        return x * self.size + y
+
+    def coordinates(self, index):
+        return divmod(index, self.size)
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.size and 0 <= y < self.size
+
+    def is_mine(self, x, y):
+        return bool(self.cells[self.index(x, y)] & MINE_FLAG)
+
+    def is_revealed(self, x, y):
+        return bool(self.cells[self.index(x, y)] & REVEALED_FLAG)
+
+    def is_empty(self, x, y):
+        return not self.cells[self.index(x, y)] & (MINE_FLAG | REVEALED_FLAG)
+
+    def count(self, x, y):
+        return self.cells[self.index(x, y)] & COUNT_MASK
+
+    def symbol(self, x, y):
+        return chr(SYMBOL_TABLE[self.cells[self.index(x, y)]])
+
+    # Adding or removing a single mine only changes the counts of its 3x3 neighbourhood
+    def clear(self, x, y):
+        index = self.index(x, y)
+        if self.cells[index] & MINE_FLAG:
+            self.add_to_neighbours(x, y, -1)
+        self.cells[index] &= COUNT_MASK
+
+    def set_mine(self, x, y):
+        index = self.index(x, y)
+        if not self.cells[index] & MINE_FLAG:
+            self.add_to_neighbours(x, y, 1)
+        self.cells[index] |= MINE_FLAG
+
+    def add_to_neighbours(self, x, y, value):
+        for nx in range(max(x - 1, 0), min(x + 2, self.size)):
+            for ny in range(max(y - 1, 0), min(y + 2, self.size)):
+                if (nx, ny) != (x, y):
+                    self.cells[self.index(nx, ny)] += value
+
+    def place_mines(self, indexes):
+        for index in indexes:
+            self.cells[index] |= MINE_FLAG
+        self.compute_counts()
+
+    # 3x3 convolution over the mine mask, done on big integers holding one byte per cell
+    def compute_counts(self):
+        length = len(self.cells)
+        if not length:
+            return
+        size = self.size
+        full = (1 << 8 * length) - 1
+        not_first_column = int.from_bytes((b'\x00' + b'\xff' * (size - 1)) * size, 'big')
+        not_last_column = int.from_bytes((b'\xff' * (size - 1) + b'\x00') * size, 'big')
+
+        mines = int.from_bytes(self.cells.translate(MINE_BYTE_TABLE), 'big')
+        rows = mines + ((mines >> 8) & not_first_column) + ((mines << 8) & not_last_column)
+        counts = rows + (rows >> 8 * size) + ((rows << 8 * size) & full) - mines
+
+        flags = int.from_bytes(self.cells.translate(FLAGS_TABLE), 'big')
+        self.cells = bytearray((flags | counts).to_bytes(length, 'big'))
+
+    def reveal(self, x, y, count):
+        self.cells[self.index(x, y)] = REVEALED_FLAG | int(count)
+
+    def define_symbol(self, x, y, symbol):
+        if symbol == MINE:
+            self.set_mine(x, y)
+        elif symbol == EMPTY:
+            self.clear(x, y)
+        else:
+            self.reveal(x, y, symbol)
+
+    def mine_count(self):
+        return self.cells.translate(MINE_BIT_TABLE).count(b'1')
+
+    def revealed_count(self):
+        return self.cells.translate(REVEALED_BIT_TABLE).count(b'1')
+
+    def are_empty_left(self):
+        return b'E' in self.cells.translate(SYMBOL_TABLE)
+
+    def adjacent(self, x, y):
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if (dx or dy) and self.in_bounds(x + dx, y + dy):
+                    yield x + dx, y + dy
+
+    def count_adjacent_mines(self, x, y):
+        return self.count(x, y)
+
+    def rows(self, table=SYMBOL_TABLE):
+        return _rows(self.cells, self.size, table)
+
+    def symbol_rows(self):
+        return self.rows(SYMBOL_TABLE)
+
+    def player_rows(self):
+        return self.rows(PLAYER_SYMBOL_TABLE)
+
+    # Map as the player sees it with 4 bits per cell: the count of revealed cells, 0xF for hidden ones
+    def player_nibbles(self):
+        return self.nibbles(PLAYER_HEX_TABLE)
+
+    # Whole map with 4 bits per cell: the count of revealed cells, 0xD for mines and 0xE for hidden cells
+    def symbol_nibbles(self):
+        return self.nibbles(SYMBOL_HEX_TABLE)
+
+    def nibbles(self, table):
+        return _nibbles(self.cells, table)
+
+    # Rectangle of height rows from x0 and width columns from y0
+    def window(self, x0, y0, height, width):
+        cells = b''.join(self.cells[x * self.size + y0:x * self.size + y0 + width] for x in range(x0, x0 + height))
+        return BoardWindow(self.size, x0, y0, height, width, cells)
+
+    def copy(self):
+        return Board(self.size, bytearray(self.cells), self.seed)
+
+    # [x, y, symbol] of every cell in the given (start, stop) index spans, as the player sees them
+    def changes(self, spans):
+        return [
+            [index // self.size, index % self.size, chr(PLAYER_SYMBOL_TABLE[self.cells[index]])]
+            for start, stop in spans
+            for index in range(start, stop)
+        ]
+
+    # Layout: header, mine bitmap, revealed bitmap, one nibble per cell with counts. Boards are
+    # always packed whole: unpacking a seeded pack runs the mine layout again, and mines edited
+    # since would be lost. Only pack_seed writes seeded packs
+    def pack(self):
+        counts = self.cells.translate(COUNT_HEX_TABLE)
+        if len(counts) % 2:
+            counts += b'0'
+        return b''.join([
+            HEADER.pack(PACK_VERSION, self.size),
+            _pack_bits(self.cells, MINE_BIT_TABLE),
+            _pack_bits(self.cells, REVEALED_BIT_TABLE),
+            bytes.fromhex(counts.decode()),
+        ])
+
+    # Bytes start to stop of the packed revealed bitmap
+    def revealed_bitmap(self, start, stop):
+        return _pack_bits(self.cells[start * 8:stop * 8], REVEALED_BIT_TABLE)
+
+    # Reveals the cells set in a whole packed revealed bitmap, as returned by revealed_bitmap
+    def merge_revealed_bitmap(self, data):
+        length = len(self.cells)
+        revealed = _unpack_bits(data, length) << 5
+        self.cells = bytearray((int.from_bytes(self.cells, 'big') | revealed).to_bytes(length, 'big'))
+
+    @classmethod
+    def unpack(cls, data):
+        data = bytes(data)
+        if data[:1] == bytes([SEEDED_PACK_VERSION]):
+            version, size, seed, mine_count = SEEDED_HEADER.unpack_from(data)
+            board = cls.from_seed(size, mine_count, seed)
+            board.seed = seed
+            board.merge_revealed_bitmap(data[SEEDED_HEADER.size:])
+            return board
+
+        version, size = HEADER.unpack_from(data)
+        if version != PACK_VERSION:
+            raise InvalidBoardDataException("Unknown board format version {}".format(version))
+
+        length = size * size
+        bitmap_length = (length + 7) // 8
+        offset = HEADER.size
+        mines = _unpack_bits(data[offset:offset + bitmap_length], length)
+        offset += bitmap_length
+        revealed = _unpack_bits(data[offset:offset + bitmap_length], length)
+        offset += bitmap_length
+        counts = data[offset:].hex()[:length].encode().translate(HEX_COUNT_TABLE)
+
+        flags = (mines << 4) | (revealed << 5)
+        cells = bytearray((int.from_bytes(counts, 'big') | flags).to_bytes(length, 'big'))
+        return cls(size, cells)
+
+    @classmethod
+    def from_seed(cls, size, mine_count, seed):
+        board = cls(size)
+        board.place_mines(MineLayout(size, mine_count, seed).indexes())
+        return board
+
+    # Packed form of from_seed without building the board, nothing is revealed yet
+    @staticmethod
+    def pack_seed(size, mine_count, seed):
+        return SEEDED_HEADER.pack(SEEDED_PACK_VERSION, size, seed, mine_count) + bytes((size * size + 7) // 8)
+
+    # Revealed symbols already count their mines, mines are placed last to recompute every count
+    @classmethod
+    def from_symbols(cls, size, symbols):
+        board = cls(size)
+        mines = []
+        for x, y, symbol in symbols:
+            if symbol == MINE:
+                mines.append(board.index(x, y))
+            else:
+                board.define_symbol(x, y, symbol)
+        board.place_mines(mines)
+        return board
+
+
+class BoardWindow:
+    """ Cells of a rectangle of a map of the given size, row by row, with the rendering methods of Board """
+
+    def __init__(self, size, x0, y0, height, width, cells):
+        self.size = size
+        self.x0 = x0
+        self.y0 = y0
+        self.height = height
+        self.width = width
+        self.cells = cells
+
+    def symbol_rows(self):
+        return _rows(self.cells, self.width, SYMBOL_TABLE)
+
+    def player_rows(self):
+        return _rows(self.cells, self.width, PLAYER_SYMBOL_TABLE)
+
+    def player_nibbles(self):
+        return _nibbles(self.cells, PLAYER_HEX_TABLE)
+
+    def symbol_nibbles(self):
+        return _nibbles(self.cells, SYMBOL_HEX_TABLE)
+
+
+class InvalidBoardDataException(Exception):
+    pass
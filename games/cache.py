@@ -0,0 +1,119 @@
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from lru import LRU
+
+from games import timing
+from games.board import Board
+
+
+class GameBoardCache:
+    """
+    Process local LRU of decoded boards keyed by game id.
+
+    Entries remember the game version they were decoded from, a game modified by another
+    worker has a newer version and is decoded again. Boards are copied in and out so a
+    move that is rolled back never leaks into the cache
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = LRU(max_entries, self._evicted)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    # Tiled games are too big to keep, they build the tiles they need on every load
+    def load(self, game):
+        if game.is_tiled:
+            return game.unpack_board()
+        with self.lock:
+            entry = self.entries.get(game.pk)
+            if entry is not None and entry[0] == game.version:
+                self.hits += 1
+                return Board(entry[1], bytearray(entry[2]), entry[3])
+            if entry is not None:
+                self.stale += 1
+            self.misses += 1
+
+        with timing.span('decode'):
+            board = game.unpack_board()
+        self.store(game, board)
+        return board
+
+    def store(self, game, board=None):
+        if game.is_tiled:
+            return
+        board = board if board is not None else game.board
+        cells = bytes(board.cells)
+        with self.lock:
+            if game.pk in self.entries:
+                self._forget(game.pk)
+            self.entries[game.pk] = (game.version, board.size, cells, board.seed)
+            self.total_bytes += len(cells)
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                self._forget(self.entries.peek_last_item()[0])
+                self.evictions += 1
+
+    def invalidate(self, pk):
+        with self.lock:
+            if pk in self.entries:
+                self._forget(pk)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+            }
+
+    def _forget(self, pk):
+        self.total_bytes -= len(self.entries[pk][2])
+        del self.entries[pk]
+
+    # Called by the LRU when it drops an entry for going over max_entries
+    def _evicted(self, pk, entry):
+        self.total_bytes -= len(entry[2])
+        self.evictions += 1
+
+
+class FinishedBoardCache:
+    """ Boards of finished games never change, they are kept in the django cache without expiry """
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    def key(self, game):
+        return 'games:finished-board:{}:{}'.format(game.pk, game.version)
+
+    def load(self, game):
+        if game.is_tiled:
+            return game.board
+        cache = caches[self.alias]
+        cells = cache.get(self.key(game))
+        if cells is not None:
+            return Board(game.size, bytearray(cells))
+
+        board = game.board
+        cache.set(self.key(game), bytes(board.cells), None)
+        return board
+
+
+board_cache = GameBoardCache(
+    getattr(settings, 'GAME_BOARD_CACHE_ENTRIES', 1024),
+    getattr(settings, 'GAME_BOARD_CACHE_BYTES', 64 * 1024 * 1024),
+)
+finished_board_cache = FinishedBoardCache(getattr(settings, 'GAME_FINISHED_BOARD_CACHE', 'default'))
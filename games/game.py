@@ -1,13 +1,23 @@
 import random
-
-
-from games.models import Game as GameModel, Field
-
+import time
+from functools import partial
+
+from games import timing
+from games.metrics import MARK_SECONDS, REVEALED_CELLS, BOARD_SIZE, GAMES_STARTED, GAMES_FINISHED, BOARD_POOL_CLAIMS
+from games.board import Board
+from games.cache import board_cache, finished_board_cache
+from games.models import Game as GameModel, Field, PooledBoard
+from games.reveal import FloodFillRevealer
+from games.tiles import TiledBoard
+
+from django.conf import settings
 from django.db import transaction
+from django.utils import timezone
 
 class GameInformationService:
     game_manager = GameModel.objects
     field_manager = Field.objects
+    finished_board_cache = finished_board_cache
 
     def __init__(self, gamemodel):
         self.gamemodel = gamemodel
@@ -22,144 +32,304 @@ class GameInformationService:
 
     @property
     def mine_count(self):
-        return len(self.field_manager.game_mines(self.gamemodel))
+        return self.gamemodel.mine_count
+
+    @property
+    def revealed_count(self):
+        return self.gamemodel.revealed_count
+
+    @property
+    def mark_count(self):
+        return self.gamemodel.mark_count
+
+    @property
+    def status(self):
+        return self.gamemodel.status
+
+    @property
+    def version(self):
+        return self.gamemodel.version
 
     @property
     def size(self):
         return self.gamemodel.size
 
+    @property
+    def is_tiled(self):
+        return self.gamemodel.is_tiled
+
+    @property
+    def board(self):
+        return self.gamemodel.board
+
+    # Finished games never change, their map comes from the shared cache
+    @property
+    def final_board(self):
+        return self.finished_board_cache.load(self.gamemodel)
+
     @property
     def user(self):
         return self.gamemodel.user
 
     def check_for_win(self):
-        return not self.field_manager.are_empty_left_on(self.gamemodel)
+        return self.gamemodel.revealed_count >= self.gamemodel.safe_count
 
     # Get a matrix version of the map
     @property
     def notrevealed_matrix(self):
-        matrix = [[None for x in range(self.gamemodel.size)] for y in range(self.gamemodel.size)]
-        fields = self.field_manager.game_fields(self.gamemodel)
-        for f in fields:
-            matrix[f.x][f.y] = '' if f.is_mine() or f.is_empty() else f.symbol
-        return matrix
+        return [[content if content != 'X' else '' for content in row] for row in self.notrevealed_matrix_string]
 
     @property
     def notrevealed_matrix_string(self):
-        matrix = self.notrevealed_matrix
-        result = []
-        for x in range(self.gamemodel.size):
-            row = []
-            for y in range(self.gamemodel.size):
-                content = matrix[x][y] if matrix[x][y] is not '' else 'X'
-                row.append(content)
-            result.append("".join(row))
-
-        return result
+        return self.gamemodel.board.player_rows()
 
     @property
     def revealed_matrix(self):
-        matrix = [[None for x in range(self.gamemodel.size)] for y in range(self.gamemodel.size)]
-        fields = self.field_manager.game_fields(self.gamemodel)
-        for f in fields:
-            matrix[f.x][f.y] = f.symbol
-        return matrix
+        return [list(row) for row in self.revealed_matrix_string]
 
     @property
     def revealed_matrix_string(self):
-        matrix = self.revealed_matrix
-        result = []
-        for x in range(self.gamemodel.size):
-            row = []
-            for y in range(self.gamemodel.size):
-                content = matrix[x][y] if matrix[x][y] is not '' else 'X'
-                row.append(content)
-            result.append("".join(row))
-        return result
+        return self.gamemodel.board.symbol_rows()
 
 class RandomMapGenerator:
+    game_manager = GameModel.objects
     field_manager = Field.objects
 
+    # Build the whole map in memory, mines are derived from a random seed so only the seed and
+    # the revealed cells are stored
+    def generate_board(self, size, mines):
+        return Board.from_seed(size, mines, random.getrandbits(63))
+
+    # Packed board of generate_board, for games created in bulk that are not looked at yet
+    def generate_packed_board(self, size, mines):
+        return Board.pack_seed(size, mines, random.getrandbits(63))
+
     # Perform initial map generation
     def generate_map(self, game, size, mines):
-        # Make empty map
-        for x in range(size):
-            for y in range(size):
-                self.field_manager.new_empty_field(game, x, y)
-
-        created_mines = 0
-        while created_mines < mines:
-            x = random.randint(0, size - 1)
-            y = random.randint(0, size - 1)
-            if not self.field_manager.is_mine_on(x, y, game):
-                self.field_manager.create_mine(x, y, game)
-                created_mines += 1
+        game.board = self.generate_board(size, mines)
+        self.game_manager.save_board(game)
 
 
 class RandomGameStarter:
     game_manager = GameModel.objects
     field_manager = Field.objects
+    pool_manager = PooledBoard.objects
     map_generator = RandomMapGenerator()
 
     def start_game(self, size, mines, user):
+        self.validate(size, mines)
+
+        # Boards too big to build at once are split in tiles built on demand
+        if self.is_tiled(size):
+            with timing.span('save'):
+                game = self.game_manager.create_tiled(user, size, mines, getattr(settings, 'GAME_TILE_SIZE', 256),
+                                                      random.getrandbits(63))
+        else:
+            with transaction.atomic():
+                with timing.span('generate'):
+                    pooled = self.claim_board(size, mines)
+                    board = self.map_generator.generate_board(size, mines) if pooled is None else None
+                with timing.span('save'):
+                    if pooled is not None:
+                        game = self.game_manager.create_with_packed_board(user, size, mines, pooled)
+                    else:
+                        game = self.game_manager.create_with_board(user=user, board=board)
+        GAMES_STARTED.inc()
+        BOARD_SIZE.observe(size)
+
+        return GameInformationService(game)
+
+    # Starts count games of the same size for each of the users. Parameters are checked right
+    # away, the games are then created lazily: the returned generator yields lists of game ids,
+    # one per batch of batch_size games written with a single insert in its own transaction
+    def start_games(self, size, mines, users, count, batch_size=1000):
+        self.validate(size, mines)
+        if count <= 0:
+            raise InvalidCountParameterException("Count is {}, must be greater than zero".format(count))
+        return self.create_games(size, mines, [user for user in users for _ in range(count)], batch_size)
+
+    def create_games(self, size, mines, users, batch_size):
+        tile_size = getattr(settings, 'GAME_TILE_SIZE', 256) if self.is_tiled(size) else None
+        for start in range(0, len(users), batch_size):
+            if tile_size is not None:
+                games = [GameModel(user=user, size=size, mine_count=mines, tile_size=tile_size,
+                                   seed=random.getrandbits(63)) for user in users[start:start + batch_size]]
+            else:
+                games = [GameModel(user=user, size=size, mine_count=mines,
+                                   packed_board=self.map_generator.generate_packed_board(size, mines))
+                         for user in users[start:start + batch_size]]
+            with transaction.atomic():
+                self.game_manager.create_many(games)
+            GAMES_STARTED.inc(len(games))
+            for _ in games:
+                BOARD_SIZE.observe(size)
+            yield [game.pk for game in games]
+
+    def validate(self, size, mines):
         if size <= 0:
             raise InvalidSizeParameterException("Size is {}, must be greater than zero".format(size))
         if mines <= 0:
             raise InvalidMinesParameterException("Mines is {}, must be greater than zero".format(mines))
+        if mines >= size * size:
+            raise InvalidMinesParameterException("Mines is {}, must be lesser than {}".format(mines, size * size))
 
-        with transaction.atomic():
-            game = self.game_manager.create(user=user, size=size)
-            self.map_generator.generate_map(game, size, mines)
+    def is_tiled(self, size):
+        return size > getattr(settings, 'GAME_TILED_MIN_SIZE', 1024)
 
-        return GameInformationService(game)
+    # Popular configurations take a packed board from the pool filled by the fill_board_pool
+    # command, None when it is empty or the configuration is not pooled and a board must be
+    # generated on the fly
+    def claim_board(self, size, mines):
+        if (size, mines) not in getattr(settings, 'GAME_POOL_CONFIGURATIONS', []):
+            return None
+        pooled = self.pool_manager.claim(size, mines)
+        BOARD_POOL_CLAIMS.inc(result='hit' if pooled is not None else 'miss')
+        return pooled
 
 
 class GameIsNotActiveException(Exception):
     pass
 
 
+class StaleGameException(Exception):
+    pass
+
+
 class GameInteractor:
     game_manager = GameModel.objects
     field_manager = Field.objects
+    board_cache = board_cache
 
-    def mark(self, game, x, y):
+    # With delta only the cells revealed by this move are returned instead of the whole map,
+    # finished games still get the whole revealed map once
+    def mark(self, game, x, y, delta=False):
         if not game.is_active:
             raise GameIsNotActiveException("Game is not active")
 
-        result = {}
+        started = time.perf_counter()
         with transaction.atomic():
-            # User chose a bomb
-            if self.field_manager.is_mine_on(x, y, game.gamemodel):
-                result['status'] = 'dead'
-                result['map'] = game.revealed_matrix_string
-                self.game_manager.set_to_not_active(game.gamemodel)
-                return result
-            num_bombs = self.field_manager.count_adjacent_mines(x, y, game.gamemodel)
-            self.field_manager.define_count(x, y, str(num_bombs), game.gamemodel)
-            win = game.check_for_win()
-            if win:
-                result['status'] = 'win'
-                result['map'] = game.revealed_matrix_string
-                self.game_manager.set_to_not_active(game.gamemodel)
-                return result
-
-            # Hit a regular space
-            if num_bombs > 0:
-                result['status'] = 'clear'
-                result['num_bombs'] = num_bombs
-                result['map'] = game.notrevealed_matrix_string
-
-            # Hit a super space
-            elif num_bombs == 0:
-                result['status'] = 'superclear'
-                result['num_bombs'] = num_bombs
-                compiler = EmptiesCompiler(game.revealed_matrix)
-                map_result = compiler.compile(x, y)
-                self.field_manager.save_fields_matrix(map_result, game.gamemodel)
-                result['map'] = game.notrevealed_matrix_string
+            with timing.span('lock'):
+                self.lock(game)
+            self.write_through(game)
+            with timing.span('reveal'):
+                status, num_bombs, revealed = self.apply_mark(game, x, y)
+            with timing.span('save'):
+                self.game_manager.save_move(game.gamemodel, revealed, [(x, y, status)])
+        MARK_SECONDS.observe(time.perf_counter() - started, outcome=status)
+
+        result = {'status': status}
+        if num_bombs is not None and status != 'win':
+            result['num_bombs'] = num_bombs
+        with timing.span('map'):
+            result.update(self.map_result(game, revealed, delta))
+        return result
+
+    # Applies ordered (x, y) marks in a single transaction, stopping at the first one that ends the game
+    def mark_many(self, game, moves, delta=False):
+        if not game.is_active:
+            raise GameIsNotActiveException("Game is not active")
+        if not moves:
+            raise InvalidMarkParameterException("At least one mark is needed")
 
+        marks = []
+        revealed = []
+        with transaction.atomic():
+            with timing.span('lock'):
+                self.lock(game)
+            self.write_through(game)
+            with timing.span('reveal'):
+                for x, y in moves:
+                    status, num_bombs, spans = self.apply_mark(game, x, y)
+                    marks.append({'x': x, 'y': y, 'status': status, 'num_bombs': num_bombs})
+                    revealed += spans
+                    if not game.is_active:
+                        break
+            with timing.span('save'):
+                self.game_manager.save_move(game.gamemodel, revealed,
+                                            [(mark['x'], mark['y'], mark['status']) for mark in marks])
+
+        result = {'status': marks[-1]['status'], 'marks': marks}
+        with timing.span('map'):
+            result.update(self.map_result(game, revealed, delta))
         return result
 
+    # Persists marks applied earlier with apply_mark, when the game was changed elsewhere in between
+    # they can not be saved
+    def save_marks(self, gamemodel, spans, moves):
+        with transaction.atomic():
+            locked = self.game_manager.find_game_for_update(gamemodel.pk)
+            if locked.version != gamemodel.version:
+                raise StaleGameException("Game {} was changed by another request".format(gamemodel.pk))
+            transaction.on_commit(partial(self.board_cache.store, gamemodel, gamemodel.board))
+            self.game_manager.save_move(gamemodel, spans, moves)
+
+    # Marks on a game are linearized by locking its row until the transaction ends, marks on other
+    # games never wait. The game is reloaded when another request changed it since it was read
+    def lock(self, game):
+        locked = self.game_manager.find_game_for_update(game.pk)
+        if locked.version != game.gamemodel.version:
+            game.gamemodel = locked
+        if not game.is_active:
+            raise GameIsNotActiveException("Game is not active")
+
+    # Reveals a cell on the board and updates the game counters in memory, returns the mark status,
+    # the adjacent mines of the cell and the revealed spans
+    def apply_mark(self, game, x, y):
+        gamemodel = game.gamemodel
+        if not gamemodel.board.in_bounds(x, y):
+            raise InvalidMarkParameterException("Mark ({}, {}) is out of a map of size {}".format(x, y, game.size))
+
+        gamemodel.mark_count += 1
+        # User chose a bomb
+        if self.field_manager.is_mine_on(x, y, gamemodel):
+            self.finish(gamemodel, GameModel.LOST)
+            return 'dead', None, []
+
+        num_bombs = self.field_manager.count_adjacent_mines(x, y, gamemodel)
+        revealed = self.reveal(gamemodel.board, x, y)
+        revealed_count = sum(stop - start for start, stop in revealed)
+        gamemodel.revealed_count += revealed_count
+        REVEALED_CELLS.observe(revealed_count)
+        if game.check_for_win():
+            self.finish(gamemodel, GameModel.WON)
+            return 'win', num_bombs, revealed
+
+        # Hit a regular space, or a super space and the whole empty region around it was revealed
+        return 'clear' if num_bombs > 0 else 'superclear', num_bombs, revealed
+
+    def reveal(self, board, x, y):
+        if isinstance(board, TiledBoard):
+            return board.reveal_spans(x, y)
+        return FloodFillRevealer(board).reveal_spans(x, y)
+
+    def finish(self, gamemodel, status):
+        gamemodel.status = status
+        gamemodel.is_active = False
+        gamemodel.end_date = timezone.now()
+        GAMES_FINISHED.inc(status=status)
+
+    # Write-through, the board of a committed move is what the next request sees
+    def write_through(self, game):
+        transaction.on_commit(partial(self.board_cache.store, game.gamemodel, game.gamemodel.board))
+
+    def map_result(self, game, revealed, delta):
+        # Tiled games are too big to send whole, they always get what changed
+        if game.is_tiled:
+            return dict(self.tiled_changes(game, revealed), version=game.version)
+        if not game.is_active:
+            return {'map': game.revealed_matrix_string, 'version': game.version}
+        if delta:
+            return {'changes': game.board.changes(revealed), 'version': game.version}
+        return {'map': game.notrevealed_matrix_string}
+
+    # Fills bigger than GAME_TILED_MAX_CHANGES cells send the [tx, ty] of the tiles they touched
+    # instead, the client gets them through viewports
+    def tiled_changes(self, game, revealed):
+        if sum(stop - start for start, stop in revealed) > getattr(settings, 'GAME_TILED_MAX_CHANGES', 10000):
+            return {'tiles': [list(position) for position in game.board.span_tiles(revealed)],
+                    'tile_size': game.board.tile_size}
+        return {'changes': game.board.changes(revealed)}
+
     # Perform chain reaction of supers to find all revealed coords
     def compile_empties(self, x, y, game):
         empties = set(self.field_manager.get_adj_empties(x, y, game))
@@ -268,3 +438,11 @@ class InvalidSizeParameterException(Exception):
 
 class InvalidMinesParameterException(Exception):
     pass
+
+
+class InvalidMarkParameterException(Exception):
+    pass
+
+
+class InvalidCountParameterException(Exception):
+    pass
@@ -0,0 +1,63 @@
+MASK64 = (1 << 64) - 1
+GOLDEN_GAMMA = 0x9e3779b97f4a7c15
+
+
+def _mix(value):
+    # splitmix64 finalizer
+    value = (value ^ (value >> 30)) * 0xbf58476d1ce4e5b9 & MASK64
+    value = (value ^ (value >> 27)) * 0x94d049bb133111eb & MASK64
+    return value ^ (value >> 31)
+
+
+class MineLayout:
+    """
+    Mines of a board derived from a seed, nothing but the seed has to be stored.
+
+    A keyed Feistel network shuffles the cell indexes (cycle walking keeps it inside the board),
+    the mines are the cells the first mine_count positions land on. Any cell can be checked on
+    its own by running the network backwards
+    """
+    ROUNDS = 4
+
+    def __init__(self, size, mine_count, seed):
+        self.length = size * size
+        self.mine_count = mine_count
+        bits = max(2, (self.length - 1).bit_length())
+        self.half = (bits + 1) // 2
+        self.mask = (1 << self.half) - 1
+        self.keys = [_mix((seed + (round + 1) * GOLDEN_GAMMA) & MASK64) for round in range(self.ROUNDS)]
+
+    def _encrypt(self, value):
+        left, right = value >> self.half, value & self.mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix(right ^ key) & self.mask)
+        return (left << self.half) | right
+
+    def _decrypt(self, value):
+        left, right = value >> self.half, value & self.mask
+        for key in reversed(self.keys):
+            left, right = right ^ (_mix(left ^ key) & self.mask), left
+        return (left << self.half) | right
+
+    # Cell the given position of the shuffle lands on
+    def permute(self, position):
+        value = self._encrypt(position)
+        while value >= self.length:
+            value = self._encrypt(value)
+        return value
+
+    def position(self, index):
+        value = self._decrypt(index)
+        while value >= self.length:
+            value = self._decrypt(value)
+        return value
+
+    def is_mine(self, index):
+        return self.position(index) < self.mine_count
+
+    # Indexes of all the mines, on crowded boards the safe cells are shuffled instead
+    def indexes(self):
+        if self.mine_count * 2 <= self.length:
+            return [self.permute(position) for position in range(self.mine_count)]
+        safe = {self.permute(position) for position in range(self.mine_count, self.length)}
+        return [index for index in range(self.length) if index not in safe]
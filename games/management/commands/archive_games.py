@@ -0,0 +1,57 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from games.models import Game, GameArchive, Field
+
+
+class Command(BaseCommand):
+    help = 'Moves the boards of finished games into compressed archive records and deletes their legacy cell rows'
+
+    game_manager = Game.objects
+    archive_manager = GameArchive.objects
+    field_manager = Field.objects
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Games archived per transaction')
+        parser.add_argument('--delete-chunk', type=int, default=10000, help='Cell rows deleted per statement')
+        parser.add_argument('--min-age-hours', type=float, default=0,
+                            help='Only games finished at least this long ago')
+        parser.add_argument('--every', type=float,
+                            help='Keep running, archiving again every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            games, cells = self.archive(options['batch_size'], options['delete_chunk'], options['min_age_hours'])
+            self.stdout.write('Archived {} games, deleted {} cell rows'.format(games, cells))
+            if options['every'] is None:
+                return
+            time.sleep(options['every'])
+
+    def archive(self, batch_size, delete_chunk, min_age_hours):
+        # Games finished before the end date was recorded count as old enough
+        finished_before = timezone.now() - timedelta(hours=min_age_hours)
+        pks = self.game_manager.filter(is_active=False, is_archived=False) \
+            .filter(Q(end_date__lte=finished_before) | Q(end_date__isnull=True)) \
+            .order_by('pk').values_list('pk', flat=True).iterator()
+
+        games = cells = 0
+        batch = []
+        for pk in pks:
+            batch.append(pk)
+            if len(batch) == batch_size:
+                archived, deleted = self.archive_batch(batch, delete_chunk)
+                games, cells, batch = games + archived, cells + deleted, []
+        if batch:
+            archived, deleted = self.archive_batch(batch, delete_chunk)
+            games, cells = games + archived, cells + deleted
+        return games, cells
+
+    def archive_batch(self, pks, delete_chunk):
+        with transaction.atomic():
+            archived = self.archive_manager.archive_games(pks)
+        return len(archived), self.field_manager.delete_game_fields(archived, delete_chunk)
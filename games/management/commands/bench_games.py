@@ -0,0 +1,148 @@
+import json
+import platform
+import random
+import time
+import tracemalloc
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIRequestFactory
+
+from games.game import RandomGameStarter, GameInteractor, GameInformationService, RandomMapGenerator
+from games.models import Game, PooledBoard
+from rest.views import GameInteractionView
+
+OPERATIONS = ['start', 'start_pooled', 'mark_clear', 'mark_superclear', 'get']
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class Command(BaseCommand):
+    help = 'Measures starting, marking and retrieving games over a seeded matrix of board sizes and mine densities'
+
+    game_starter = RandomGameStarter()
+    game_marker = GameInteractor()
+    game_manager = Game.objects
+    pool_manager = PooledBoard.objects
+    map_generator = RandomMapGenerator()
+    game_view = staticmethod(GameInteractionView.as_view())
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10, 50, 100, 200])
+        parser.add_argument('--densities', nargs='+', type=float, default=[0.05, 0.15, 0.3],
+                            help='Fractions of cells holding a mine')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed samples per operation')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Path of the json report')
+
+    def handle(self, *args, **options):
+        self.factory = APIRequestFactory()
+        self.user = User.objects.create(username='bench-games-{}'.format(time.time()))
+        try:
+            results = []
+            for size in options['sizes']:
+                for density in options['densities']:
+                    results += self.bench(size, density, options['repeat'], options['seed'])
+        finally:
+            # Games go away with their user
+            self.user.delete()
+
+        report = {
+            'meta': {
+                'seed': options['seed'],
+                'repeat': options['repeat'],
+                'database': connection.vendor,
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            },
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+
+        self.stdout.write('{:>6} {:>8} {:>16} {:>9} {:>9} {:>9} {:>8} {:>12}'.format(
+            'size', 'density', 'operation', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'queries', 'peak (KiB)'))
+        for result in results:
+            self.stdout.write('{size:>6} {density:>8} {operation:>16} {p50_ms:>9.2f} {p95_ms:>9.2f} {p99_ms:>9.2f} '
+                              '{queries:>8} {peak_kib:>12.1f}'.format(peak_kib=result['peak_memory_bytes'] / 1024,
+                                                                      **result))
+
+    def bench(self, size, density, repeat, seed):
+        mines = max(1, min(size * size - 1, int(size * size * density)))
+        # Every configuration is seeded on its own so runs with other matrices stay comparable
+        random.seed('{}-{}-{}'.format(seed, size, density))
+        samples = {operation: {'times': [], 'queries': 0, 'peak': 0} for operation in OPERATIONS}
+
+        # The first round is not timed, it warms up and measures peak memory under tracemalloc
+        for attempt in range(repeat + 1):
+            traced = attempt == 0
+            game = self.measure(samples['start'], traced, self.game_starter.start_game, size, mines, self.user)
+            clear, superclear = self.pick_cells(game.gamemodel.board)
+            if clear is not None:
+                self.measure(samples['mark_clear'], traced, self.mark, game.pk, *clear)
+            if superclear is not None:
+                self.measure(samples['mark_superclear'], traced, self.mark, game.pk, *superclear)
+            self.measure(samples['get'], traced, self.get, game.pk)
+
+            # Same start taking a board put in the pool beforehand, untimed
+            self.pool_manager.add_boards([self.map_generator.generate_board(size, mines)])
+            with override_settings(GAME_POOL_CONFIGURATIONS=[(size, mines)]):
+                self.measure(samples['start_pooled'], traced, self.game_starter.start_game, size, mines, self.user)
+
+        return [
+            {
+                'size': size,
+                'density': density,
+                'mines': mines,
+                'operation': operation,
+                'samples': len(sample['times']),
+                'p50_ms': percentile(sample['times'], 0.5) * 1000,
+                'p95_ms': percentile(sample['times'], 0.95) * 1000,
+                'p99_ms': percentile(sample['times'], 0.99) * 1000,
+                'queries': sample['queries'],
+                'peak_memory_bytes': sample['peak'],
+            }
+            for operation, sample in samples.items() if sample['times']
+        ]
+
+    def measure(self, sample, traced, func, *args):
+        if traced:
+            tracemalloc.start()
+            try:
+                result = func(*args)
+                sample['peak'] = max(sample['peak'], tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+            return result
+
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            result = func(*args)
+            sample['times'].append(time.perf_counter() - started)
+        sample['queries'] = max(sample['queries'], len(queries))
+        return result
+
+    # A safe cell with adjacent mines and a safe cell opening a region, when the board has them
+    def pick_cells(self, board):
+        clear, superclear = [], []
+        for index, value in enumerate(board.cells):
+            if not board.is_mine(*board.coordinates(index)):
+                (clear if value else superclear).append(board.coordinates(index))
+        return (random.choice(clear) if clear else None,
+                random.choice(superclear) if superclear else None)
+
+    # Marks and gets load the game like the views do
+    def mark(self, pk, x, y):
+        return self.game_marker.mark(GameInformationService(self.game_manager.find_game_by_id(pk)), x, y)
+
+    def get(self, pk):
+        response = self.game_view(self.factory.get('/api/v1/games/{}'.format(pk)), game_id=pk)
+        return response.render()
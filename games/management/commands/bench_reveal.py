@@ -0,0 +1,55 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from games.board import Board
+from games.game import EmptiesCompiler
+from games.reveal import FloodFillRevealer
+
+
+class Command(BaseCommand):
+    help = 'Compares FloodFillRevealer against EmptiesCompiler opening the biggest empty region of a board'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[50, 100, 200, 1000])
+        parser.add_argument('--density', type=float, default=0.01, help='Fraction of cells holding a mine')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--compiler-max-size', type=int, default=100,
+                            help='EmptiesCompiler is skipped on bigger boards, it takes minutes there')
+
+    def handle(self, *args, **options):
+        self.stdout.write('{:>6} {:>10} {:>14} {:>14}'.format('size', 'revealed', 'revealer (ms)', 'compiler (ms)'))
+        for size in options['sizes']:
+            board = self.make_board(size, options['density'], options['seed'])
+            x, y = board.coordinates(board.cells.index(0))
+
+            revealer_times = []
+            for _ in range(options['repeat']):
+                copy = Board(size, bytearray(board.cells))
+                started = time.perf_counter()
+                spans = FloodFillRevealer(copy).reveal_spans(x, y)
+                revealer_times.append(time.perf_counter() - started)
+
+            compiler_time = '-'
+            if size <= options['compiler_max_size']:
+                compiler_times = []
+                for _ in range(options['repeat']):
+                    compiler = EmptiesCompiler([list(row) for row in board.symbol_rows()])
+                    started = time.perf_counter()
+                    compiler.compile(x, y)
+                    compiler_times.append(time.perf_counter() - started)
+                compiler_time = '{:.2f}'.format(min(compiler_times) * 1000)
+
+            self.stdout.write('{:>6} {:>10} {:>14.2f} {:>14}'.format(
+                size, sum(stop - start for start, stop in spans), min(revealer_times) * 1000, compiler_time))
+
+    def make_board(self, size, density, seed):
+        rng = random.Random(seed)
+        board = Board(size)
+        board.place_mines(rng.sample(range(size * size), int(size * size * density)))
+        # Make sure there is a cell without adjacent mines to start from
+        if 0 not in board.cells:
+            board = Board(size)
+        return board
@@ -0,0 +1,24 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from games.models import GameMove
+
+
+class Command(BaseCommand):
+    help = 'Writes the move log of games as json lines, in play order'
+
+    move_manager = GameMove.objects
+
+    def add_arguments(self, parser):
+        parser.add_argument('games', nargs='*', type=int, help='Game ids, every game when none is given')
+        parser.add_argument('--output', help='Path of the json lines file, standard output by default')
+
+    def handle(self, *args, **options):
+        output = open(options['output'], 'w') if options['output'] else self.stdout
+        try:
+            for game, number, x, y, status in self.move_manager.export(options['games'] or None):
+                output.write(json.dumps({'game': game, 'number': number, 'x': x, 'y': y, 'status': status}) + '\n')
+        finally:
+            if options['output']:
+                output.close()
@@ -0,0 +1,54 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from games.game import RandomMapGenerator
+from games.metrics import registry, BOARD_POOL_REFILLS
+from games.models import PooledBoard
+
+
+class Command(BaseCommand):
+    help = 'Keeps a pool of ready made boards for the configurations in GAME_POOL_CONFIGURATIONS'
+
+    pool_manager = PooledBoard.objects
+    map_generator = RandomMapGenerator()
+
+    def add_arguments(self, parser):
+        parser.add_argument('--depth', type=int, help='Boards kept per configuration, GAME_POOL_DEPTH by default')
+        parser.add_argument('--batch-size', type=int, default=50, help='Boards inserted per statement')
+        parser.add_argument('--every', type=float,
+                            help='Keep running, topping the pool up again every this many seconds')
+
+    def handle(self, *args, **options):
+        depth = options['depth'] if options['depth'] is not None else getattr(settings, 'GAME_POOL_DEPTH', 100)
+        # The filler is a process of its own, its refills reach /metrics through its dump in
+        # METRICS_DIR while it keeps running. The dump goes away with the process
+        exported = registry.directory is not None and options['every'] is not None
+        if not exported:
+            self.stderr.write('Refills are only exported to /metrics with METRICS_DIR set and --every, '
+                              'minesweeper_board_pool_depth shows the pool')
+        try:
+            while True:
+                added = self.fill(getattr(settings, 'GAME_POOL_CONFIGURATIONS', []), depth, options['batch_size'])
+                if exported:
+                    registry.dump()
+                self.stdout.write('Added {} boards to the pool'.format(added))
+                if options['every'] is None:
+                    return
+                time.sleep(options['every'])
+        finally:
+            if registry.directory is not None:
+                registry.close()
+
+    def fill(self, configurations, depth, batch_size):
+        depths = self.pool_manager.depths()
+        added = 0
+        for size, mines in configurations:
+            missing = depth - depths.get((size, mines), 0)
+            while missing > 0:
+                count = min(batch_size, missing)
+                self.pool_manager.add_boards([self.map_generator.generate_board(size, mines) for _ in range(count)])
+                BOARD_POOL_REFILLS.inc(count, size=size, mines=mines)
+                added, missing = added + count, missing - count
+        return added
@@ -1,40 +1,247 @@
-from django.db import models
+import zlib
+
+from django.conf import settings
+from django.db import models, connections
+from django.db.models import Count
+
+from games.board import Board
+from games.reveal import FloodFillRevealer
+
 
 class GameManager(models.Manager):
 
+    # The packed board is only read when the board cache misses
     def find_game_by_id(self, pk):
-        return self.get(pk=pk)
+        return self.defer('packed_board').get(pk=pk)
+
+    # Row lock held until the end of the current transaction
+    def find_game_for_update(self, pk):
+        return self.select_for_update().defer('packed_board').get(pk=pk)
 
     def set_to_not_active(self, game):
-        game.active = False
-        game.save()
+        game.is_active = False
+        self.filter(pk=game.pk).update(is_active=False)
+
+    # Tiled games only get their row, tiles are built when first touched
+    def create_tiled(self, user, size, mines, tile_size, seed):
+        return self.create(user=user, size=size, mine_count=mines, tile_size=tile_size, seed=seed)
+
+    # Game row and its map are written with a single insert
+    def create_with_board(self, user, board):
+        game = self.create(user=user, size=board.size, packed_board=board.pack(),
+                           mine_count=board.mine_count(), revealed_count=board.revealed_count())
+        game.board = board
+        return game
+
+    # Game row of a board packed ahead of time, like the ones of the board pool, nothing is
+    # revealed yet. The board is only decoded when it is used
+    def create_with_packed_board(self, user, size, mines, packed_board):
+        return self.create(user=user, size=size, packed_board=packed_board, mine_count=mines)
+
+    # Games built in memory with their packed boards are written with a single insert, databases
+    # that can not return the ids of a bulk insert get an insert per game
+    def create_many(self, games):
+        if connections[self.db].features.can_return_ids_from_bulk_insert:
+            return self.bulk_create(games)
+        for game in games:
+            game.save(force_insert=True)
+        return games
+
+    # Persist the whole map with a single row write, it becomes the snapshot of the game
+    def save_board(self, game):
+        game.packed_board = game.board.pack()
+        game.board.seed = None
+        game.mine_count = game.board.mine_count()
+        game.revealed_count = game.board.revealed_count()
+        game.snapshot_move = game.mark_count
+        game.version += 1
+        self.filter(pk=game.pk).update(packed_board=game.packed_board, mine_count=game.mine_count,
+                                       revealed_count=game.revealed_count, snapshot_move=game.snapshot_move,
+                                       version=models.F('version') + 1)
+
+    # Marks already applied to the game in memory are appended to its move log and the counters
+    # are written with a single UPDATE. The board itself is only written as a snapshot every
+    # GAME_SNAPSHOT_INTERVAL moves and when the game ends, loads replay the moves after it
+    def save_move(self, game, spans, moves):
+        revealed = sum(stop - start for start, stop in spans)
+        game.version += 1
+        changes = {
+            'revealed_count': models.F('revealed_count') + revealed,
+            'mark_count': models.F('mark_count') + len(moves),
+            'status': game.status,
+            'is_active': game.is_active,
+            'end_date': game.end_date,
+            'version': models.F('version') + 1,
+        }
+        game.moves.append(game, moves)
+        if spans and game.is_tiled:
+            game.board.save_tiles()
+        elif not game.is_tiled and self.snapshot_due(game):
+            game.packed_board = game.board.pack()
+            game.board.seed = None
+            game.snapshot_move = game.mark_count
+            changes.update(packed_board=game.packed_board, snapshot_move=game.snapshot_move)
+        self.filter(pk=game.pk).update(**changes)
+
+    # Boards still stored as their seed are snapshot on their first mark, every load of a seeded
+    # pack runs the whole mine layout again
+    def snapshot_due(self, game):
+        interval = getattr(settings, 'GAME_SNAPSHOT_INTERVAL', 64)
+        return not game.is_active or game.board.seed is not None or game.mark_count - game.snapshot_move >= interval
+
+
+class GameArchiveManager(models.Manager):
+
+    # Finished games among the given ones get their packed board compressed into an archive
+    # record and cleared from the game row, returns the archived game ids. Tiled games have no
+    # packed board to archive
+    def archive_games(self, pks):
+        Game = self.model._meta.get_field('game').related_model
+        games = Game.objects.select_for_update().filter(pk__in=pks, is_active=False, is_archived=False,
+                                                          tile_size__isnull=True)
+        archives = [
+            self.model(game_id=pk, packed_board=zlib.compress(bytes(packed or Board(size).pack()), 9))
+            for pk, size, packed in games.values_list('pk', 'size', 'packed_board')
+        ]
+        self.bulk_create(archives)
+        archived = [archive.game_id for archive in archives]
+        Game.objects.filter(pk__in=archived).update(is_archived=True, packed_board=None)
+        return archived
+
+
+class GameMoveManager(models.Manager):
+    """ Append only log of the marks played on a game, used through game.moves """
+
+    # Moves are numbered after the mark count of the game they lead to, game.mark_count already
+    # includes the given (x, y, status) moves
+    def append(self, game, moves):
+        first = game.mark_count - len(moves) + 1
+        self.bulk_create([
+            self.model(game=game, number=first + offset, x=x, y=y, outcome=self.model.OUTCOMES.index(status))
+            for offset, (x, y, status) in enumerate(moves)
+        ])
+
+    # Reveals again the cells of the moves numbered after `after` up to `until`, moves that hit a
+    # mine revealed nothing. Moves past `until` were played after the game row was read, the
+    # board must match its version
+    def replay(self, board, after, until):
+        revealer = FloodFillRevealer(board)
+        moves = self.filter(number__gt=after, number__lte=until).order_by('number').values_list('x', 'y', 'outcome')
+        for x, y, outcome in moves.iterator():
+            if self.model.OUTCOMES[outcome] != 'dead':
+                revealer.reveal_spans(x, y)
+        return board
+
+    # (game, number, x, y, status) of every move of the given games in play order, a sequential
+    # scan of the (game, number) index
+    def export(self, pks=None):
+        moves = self.all() if pks is None else self.filter(game_id__in=pks)
+        rows = moves.order_by('game_id', 'number').values_list('game_id', 'number', 'x', 'y', 'outcome')
+        for game_id, number, x, y, outcome in rows.iterator():
+            yield game_id, number, x, y, self.model.OUTCOMES[outcome]
+
+
+class PooledBoardManager(models.Manager):
+    """ Boards generated ahead of time, keyed by (size, mine_count) """
+
+    # Takes the packed board of the oldest board of a configuration out of the pool, None when it
+    # is empty. It is written to the new game as it is, claims never decode a board. Rows locked
+    # by other claims are skipped so concurrent starts never wait on each other, postgres takes
+    # the row with a single statement. Callers must be in a transaction
+    def claim(self, size, mines):
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'DELETE FROM {table} WHERE id = (SELECT id FROM {table} WHERE size = %s AND mine_count = %s '
+                    'ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING packed_board'.format(table=table),
+                    [size, mines])
+                pooled = cursor.fetchone()
+            return bytes(pooled[0]) if pooled is not None else None
+
+        pooled = self.select_for_update(skip_locked=True).filter(size=size, mine_count=mines) \
+            .order_by('pk').values_list('pk', 'packed_board').first()
+        if pooled is None:
+            return None
+        self.filter(pk=pooled[0]).delete()
+        return bytes(pooled[1])
+
+    # Boards are stored packed whole, with their mines and counts ready
+    def add_boards(self, boards):
+        self.bulk_create([
+            self.model(size=board.size, mine_count=board.mine_count(), packed_board=board.pack()) for board in boards
+        ])
+
+    # Boards waiting in the pool by (size, mine_count)
+    def depths(self):
+        rows = self.values_list('size', 'mine_count').annotate(depth=Count('pk')).order_by()
+        return {(size, mines): depth for size, mines, depth in rows}
+
+
+class BoardTileManager(models.Manager):
+    """ Revealed bitmaps of the tiles of a game, used through game.tiles """
+
+    def load_bitmap(self, tx, ty):
+        bitmap = self.filter(tx=tx, ty=ty).values_list('revealed', flat=True).first()
+        return bytes(bitmap) if bitmap is not None else None
+
+    # Callers hold the game row lock, a tile can not be created twice
+    def save_bitmaps(self, bitmaps):
+        for (tx, ty), bitmap in bitmaps.items():
+            if not self.filter(tx=tx, ty=ty).update(revealed=bitmap):
+                self.create(tx=tx, ty=ty, revealed=bitmap)
 
 
 class FieldManager(models.Manager):
+    """
+    Cell level access to a game map.
+
+    Cells live in the packed board of the game, mutating methods only change the decoded
+    board in memory and GameManager.save_board persists it
+    """
 
+    # Legacy per cell rows
     def game_fields_queryset(self, game):
         return self.filter(game=game)
 
     def game_fields(self, game):
-        return set(self.game_fields_queryset(game))
+        board = game.board
+        return [
+            self.model(game=game, x=x, y=y, symbol=board.symbol(x, y))
+            for x in range(board.size) for y in range(board.size)
+        ]
 
+    # Legacy per cell rows
     def game_mines_queryset(self, game):
         return self.filter(game=game, symbol='M')
 
     def game_mines(self, game):
-        return set(self.game_mines_queryset(game))
+        return [f for f in self.game_fields(game) if f.is_mine()]
+
+    # Legacy rows of the given games are deleted chunk_size at a time, every chunk is a short
+    # statement of its own
+    def delete_game_fields(self, pks, chunk_size):
+        deleted = 0
+        while True:
+            chunk = list(self.filter(game_id__in=pks).values_list('pk', flat=True)[:chunk_size])
+            if not chunk:
+                return deleted
+            deleted += self.filter(pk__in=chunk).delete()[0]
 
     def new_empty_field(self, game, x, y):
-        return self.create(game=game, x=x, y=y, symbol='E')
+        game.board.clear(x, y)
+        return self.model(game=game, x=x, y=y, symbol='E')
 
     def is_mine_on(self, x, y, game):
-        return self.filter(x=x, y=y, game=game, symbol='M').exists()
+        return game.board.is_mine(x, y)
 
     def is_empty_on(self, x, y, game):
-        return self.filter(x=x, y=y, game=game, symbol='E').exists()
+        return game.board.is_empty(x, y)
 
     def create_mine(self, x, y, game):
-        return self.update_or_create(x=x, y=y, game=game, defaults={'symbol':'M'})
+        game.board.set_mine(x, y)
+        return self.model(game=game, x=x, y=y, symbol='M')
 
     def save_fields_matrix(self, fields_matrix, game):
         for x in range(len(fields_matrix)):
@@ -42,26 +249,15 @@ class FieldManager(models.Manager):
                 self.define_count(x, y, fields_matrix[x][y], game)
 
     def count_adjacent_mines(self, x, y, game):
-        count = 0
-        coords = self.adj_coords(x, y)
-
-        for pair in coords:
-            out_of_bounds_x = pair[0] < 0 or pair[0] >= game.size
-            out_of_bounds_y = pair[1] < 0 or pair[1] >= game.size
-
-            if out_of_bounds_x or out_of_bounds_y:
-                continue
-
-            if self.is_mine_on(pair[0], pair[1], game):
-                count += 1
-
-        return count
+        return game.board.count_adjacent_mines(x, y)
 
     def find_field_by_coordenates(self, x, y, game):
-        return self.filter(game=game, x=x, y=y).first()
+        if not game.board.in_bounds(x, y):
+            return None
+        return self.model(game=game, x=x, y=y, symbol=game.board.symbol(x, y))
 
     def define_count(self, x, y, count, game):
-        self.filter(game=game, x=x, y=y).update(symbol=str(count))
+        game.board.define_symbol(x, y, str(count))
 
     def adj_coords(self, x, y):
         return [
@@ -75,4 +271,4 @@ class FieldManager(models.Manager):
           [x-1, y+1]
         ]
     def are_empty_left_on(self, game):
-        return self.filter(game=game, symbol='E').exists()
+        return game.board.are_empty_left()
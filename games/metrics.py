@@ -0,0 +1,320 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from django.conf import settings
+
+from games.cache import board_cache
+from games.models import PooledBoard
+
+INF = float('inf')
+DUMP_NAME = re.compile(r'metrics-(\d+)\.json$')
+
+
+def _labels_key(labelnames, labels):
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value.replace('\\', r'\\').replace('"', r'\"'))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    return '+Inf' if value == INF else repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _labels_key(self.labelnames, labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.changed()
+
+    def snapshot(self):
+        return [[list(key), value] for key, value in self.values.items()]
+
+    @staticmethod
+    def merge(values, other):
+        return values + other
+
+    def lines(self, values):
+        for key, value in sorted(values.items()):
+            yield '{}{} {}'.format(self.name, _format_labels(list(zip(self.labelnames, key))), _format_value(value))
+
+
+class Collected(Counter):
+    """
+    Values read from a callback of (labels, value) pairs at collection time, workers are added up.
+
+    Shared values are the same for every worker, like database counts, they are only read by the
+    worker rendering /metrics and never dumped
+    """
+
+    def __init__(self, registry, name, documentation, labelnames, collect, kind, shared=False):
+        super().__init__(registry, name, documentation, labelnames)
+        self.collect = collect
+        self.kind = kind
+        self.shared = shared
+
+    def snapshot(self):
+        self.values = {_labels_key(self.labelnames, labels): value for labels, value in self.collect()}
+        return super().snapshot()
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, buckets, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = list(buckets) + [INF]
+        # Per label values: a count per bucket, then the sum and the count of observations
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = _labels_key(self.labelnames, labels)
+        with self.registry.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * len(self.buckets) + [0, 0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+        self.registry.changed()
+
+    def snapshot(self):
+        return [[list(key), list(counts)] for key, counts in self.values.items()]
+
+    @staticmethod
+    def merge(values, other):
+        return [a + b for a, b in zip(values, other)]
+
+    def lines(self, values):
+        for key, counts in sorted(values.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name, _format_labels(labels + [('le', _format_value(bound))]),
+                                              cumulative)
+            yield '{}_sum{} {}'.format(self.name, _format_labels(labels), _format_value(counts[-2]))
+            yield '{}_count{} {}'.format(self.name, _format_labels(labels), counts[-1])
+
+
+def timed(histogram, **labels):
+    """
+    Observes the seconds taken by the decorated view method, labeled with its name as method.
+    Streamed responses are observed once their body has been sent
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+
+            def observe():
+                histogram.observe(time.perf_counter() - started, method=func.__name__, **labels)
+
+            try:
+                response = func(*args, **kwargs)
+            except BaseException:
+                observe()
+                raise
+            if getattr(response, 'streaming', False):
+                response.streaming_content = _observed(response.streaming_content, observe)
+            else:
+                observe()
+            return response
+        return wrapper
+    return decorator
+
+
+def _observed(content, observe):
+    try:
+        yield from content
+    finally:
+        observe()
+
+
+class Registry:
+    """
+    In process metrics rendered in the prometheus text format.
+
+    Every gunicorn worker has its own registry and by default /metrics shows the worker that
+    answered it. With a directory, each worker writes its snapshot there at most every
+    dump_interval seconds and /metrics adds up the snapshots of all of them
+    """
+
+    def __init__(self, directory=None, dump_interval=1.0):
+        self.directory = directory
+        self.dump_interval = dump_interval
+        self.metrics = []
+        self.lock = threading.Lock()
+        self.dump_timer = None
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(self, name, documentation, labelnames))
+
+    def collected(self, name, documentation, labelnames, collect, kind='gauge', shared=False):
+        return self.register(Collected(self, name, documentation, labelnames, collect, kind, shared))
+
+    def histogram(self, name, documentation, buckets, labelnames=()):
+        return self.register(Histogram(self, name, documentation, buckets, labelnames))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        with self.lock:
+            return {metric.name: metric.snapshot() for metric in self.metrics if not getattr(metric, 'shared', False)}
+
+    # Schedules a dump of this worker when metrics are shared through a directory
+    def changed(self):
+        if self.directory is None:
+            return
+        with self.lock:
+            if self.dump_timer is None:
+                self.dump_timer = threading.Timer(self.dump_interval, self.dump)
+                self.dump_timer.daemon = True
+                self.dump_timer.start()
+
+    def dump_path(self, pid):
+        return os.path.join(self.directory, 'metrics-{}.json'.format(pid))
+
+    def dump(self):
+        with self.lock:
+            timer, self.dump_timer = self.dump_timer, None
+        if timer is not None:
+            timer.cancel()
+        snapshot = self.snapshot()
+        descriptor, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as dump:
+            json.dump(snapshot, dump)
+        os.replace(path, self.dump_path(os.getpid()))
+
+    # Stops dumping and removes the dump of this process, for processes that are done counting
+    def close(self):
+        with self.lock:
+            timer, self.dump_timer = self.dump_timer, None
+        if timer is not None:
+            timer.cancel()
+        self.remove_dump(os.getpid())
+
+    def remove_dump(self, pid):
+        try:
+            os.remove(self.dump_path(pid))
+        except FileNotFoundError:
+            pass
+
+    # Dumps of processes that are gone are removed instead of being added up, gunicorn.conf.py
+    # removes the ones of workers as soon as they exit
+    def snapshots(self):
+        if self.directory is None:
+            return [self.snapshot()]
+
+        self.dump()
+        snapshots = []
+        for filename in os.listdir(self.directory):
+            match = DUMP_NAME.match(filename)
+            if match is None:
+                continue
+            pid = int(match.group(1))
+            if not _is_running(pid):
+                self.remove_dump(pid)
+                continue
+            try:
+                with open(self.dump_path(pid)) as dump:
+                    snapshots.append(json.load(dump))
+            except FileNotFoundError:
+                pass
+        return snapshots
+
+    def render(self):
+        merged = {metric.name: {} for metric in self.metrics}
+        for snapshot in self.snapshots():
+            for metric in self.metrics:
+                values = merged[metric.name]
+                for key, value in snapshot.get(metric.name, []):
+                    key = tuple(key)
+                    values[key] = metric.merge(values[key], value) if key in values else value
+        for metric in self.metrics:
+            if getattr(metric, 'shared', False):
+                merged[metric.name] = {tuple(key): value for key, value in metric.snapshot()}
+
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.lines(merged[metric.name]))
+        return '\n'.join(lines) + '\n'
+
+
+def _board_cache_events():
+    stats = board_cache.stats()
+    return [({'event': event}, stats[event]) for event in ('hits', 'misses', 'stale', 'evictions')]
+
+
+def _board_cache_usage():
+    stats = board_cache.stats()
+    return [({'unit': unit}, stats[unit]) for unit in ('entries', 'bytes')]
+
+
+def _board_pool_depths():
+    return [({'size': size, 'mines': mines}, depth) for (size, mines), depth in PooledBoard.objects.depths().items()]
+
+
+registry = Registry(getattr(settings, 'METRICS_DIR', None), getattr(settings, 'METRICS_DUMP_INTERVAL', 1.0))
+
+MARK_SECONDS = registry.histogram(
+    'minesweeper_mark_seconds', 'Time to apply and save a mark by outcome',
+    [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5], ['outcome'])
+REVEALED_CELLS = registry.histogram(
+    'minesweeper_revealed_cells', 'Cells opened by a single mark, flood fill regions included',
+    [1, 2, 4, 8, 16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576])
+BOARD_SIZE = registry.histogram(
+    'minesweeper_board_size', 'Side of the boards of started games',
+    [5, 10, 20, 50, 100, 200, 500, 1000, 2000])
+GAMES_STARTED = registry.counter('minesweeper_games_started_total', 'Games started')
+GAMES_FINISHED = registry.counter('minesweeper_games_finished_total', 'Games finished by status', ['status'])
+REQUEST_SECONDS = registry.histogram(
+    'minesweeper_request_seconds', 'Time spent in game views',
+    [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5], ['view', 'method'])
+registry.collected('minesweeper_board_cache_events_total', 'Board cache hits, misses, stale entries and evictions',
+                   ['event'], _board_cache_events, 'counter')
+registry.collected('minesweeper_board_cache_usage', 'Boards and bytes held by the board cache', ['unit'],
+                   _board_cache_usage)
+BOARD_POOL_CLAIMS = registry.counter('minesweeper_board_pool_claims_total',
+                                     'Starts of pooled configurations by whether the pool had a board', ['result'])
+BOARD_POOL_REFILLS = registry.counter('minesweeper_board_pool_refills_total', 'Boards added to the board pool',
+                                      ['size', 'mines'])
+registry.collected('minesweeper_board_pool_depth', 'Boards waiting in the board pool', ['size', 'mines'],
+                   _board_pool_depths, shared=True)
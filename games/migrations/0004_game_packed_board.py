@@ -0,0 +1,67 @@
+# Generated by Django 2.1.11 on 2026-10-18 12:00
+
+import struct
+
+from django.db import migrations, models
+
+# Copy of the version 1 packed board format of games.board as it was when this migration was
+# written: header, mine bitmap, revealed bitmap and a nibble per cell with its adjacent mine
+# count. Cells are one byte, the count in the low nibble and the mine and revealed flags above
+COUNT_MASK = 0x0F
+DIGITS = '0123456789abcdef'
+MINE_FLAG = 0x10
+REVEALED_FLAG = 0x20
+PACK_VERSION = 1
+HEADER = struct.Struct('>BI')
+
+
+def _bitmap(cells, flag):
+    bits = ''.join('1' if cell & flag else '0' for cell in cells)
+    bits += '0' * (-len(bits) % 8)
+    return int(bits, 2).to_bytes(len(bits) // 8, 'big') if bits else b''
+
+
+def pack_board(size, cells):
+    counts = ''.join(DIGITS[cell & COUNT_MASK] for cell in cells)
+    if len(counts) % 2:
+        counts += '0'
+    return HEADER.pack(PACK_VERSION, size) + _bitmap(cells, MINE_FLAG) + _bitmap(cells, REVEALED_FLAG) + \
+        bytes.fromhex(counts)
+
+
+# Legacy symbols: M for mines, E for hidden cells and the adjacent mine count of revealed ones
+def symbol_cell(symbol):
+    if symbol == 'M':
+        return MINE_FLAG
+    if symbol == 'E':
+        return 0
+    return REVEALED_FLAG | int(symbol)
+
+
+def pack_legacy_fields(apps, schema_editor):
+    Game = apps.get_model('games', 'Game')
+    Field = apps.get_model('games', 'Field')
+
+    games = Game.objects.filter(packed_board__isnull=True).values_list('pk', 'size')
+    for pk, size in games.iterator():
+        cells = Field.objects.filter(game_id=pk).values_list('x', 'y', 'symbol')
+        board = [0] * (size * size)
+        for x, y, symbol in cells.iterator():
+            board[x * size + y] = symbol_cell(symbol)
+        Game.objects.filter(pk=pk).update(packed_board=pack_board(size, board))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0003_auto_20190918_1747'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='packed_board',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(pack_legacy_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 2.1.11 on 2026-10-18 12:30
+
+import struct
+
+from django.db import migrations
+
+# Copy of the version 1 packed board format of games.board as it was when this migration was
+# written: header, mine bitmap, revealed bitmap and a nibble per cell with its adjacent mine
+# count. Cells are one byte, the count in the low nibble and the mine and revealed flags above
+COUNT_MASK = 0x0F
+DIGITS = '0123456789abcdef'
+MINE_FLAG = 0x10
+REVEALED_FLAG = 0x20
+PACK_VERSION = 1
+HEADER = struct.Struct('>BI')
+
+
+def _bitmap(cells, flag):
+    bits = ''.join('1' if cell & flag else '0' for cell in cells)
+    bits += '0' * (-len(bits) % 8)
+    return int(bits, 2).to_bytes(len(bits) // 8, 'big') if bits else b''
+
+
+def pack_board(size, cells):
+    counts = ''.join(DIGITS[cell & COUNT_MASK] for cell in cells)
+    if len(counts) % 2:
+        counts += '0'
+    return HEADER.pack(PACK_VERSION, size) + _bitmap(cells, MINE_FLAG) + _bitmap(cells, REVEALED_FLAG) + \
+        bytes.fromhex(counts)
+
+
+def _bits(data, length):
+    return [bit == '1' for bit in bin(int.from_bytes(data, 'big'))[2:].zfill(len(data) * 8)[:length]]
+
+
+def unpack_board(data):
+    data = bytes(data)
+    version, size = HEADER.unpack_from(data)
+    length = size * size
+    bitmap_length = (length + 7) // 8
+    offset = HEADER.size
+    mines = _bits(data[offset:offset + bitmap_length], length)
+    revealed = _bits(data[offset + bitmap_length:offset + 2 * bitmap_length], length)
+    counts = data[offset + 2 * bitmap_length:].hex()[:length]
+    cells = [int(count, 16) | (MINE_FLAG if mine else 0) | (REVEALED_FLAG if shown else 0)
+             for mine, shown, count in zip(mines, revealed, counts)]
+    return size, cells
+
+
+def compute_counts(size, cells):
+    counted = []
+    for index, cell in enumerate(cells):
+        x, y = divmod(index, size)
+        mines = sum(1 for ax in range(max(x - 1, 0), min(x + 2, size)) for ay in range(max(y - 1, 0), min(y + 2, size))
+                    if (ax, ay) != (x, y) and cells[ax * size + ay] & MINE_FLAG)
+        counted.append((cell & ~COUNT_MASK) | mines)
+    return counted
+
+
+def precompute_counts(apps, schema_editor):
+    Game = apps.get_model('games', 'Game')
+
+    games = Game.objects.filter(packed_board__isnull=False).values_list('pk', 'packed_board')
+    for pk, packed_board in games.iterator():
+        size, cells = unpack_board(packed_board)
+        Game.objects.filter(pk=pk).update(packed_board=pack_board(size, compute_counts(size, cells)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0004_game_packed_board'),
+    ]
+
+    operations = [
+        migrations.RunPython(precompute_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 2.1.11 on 2026-10-18 13:30
+
+import struct
+
+from django.db import migrations, models
+
+# Copy of the version 1 packed board format of games.board as it was when this migration was
+# written: header, mine bitmap, revealed bitmap and a nibble per cell with its adjacent mine
+# count. Cells are one byte, the count in the low nibble and the mine and revealed flags above
+MINE_FLAG = 0x10
+REVEALED_FLAG = 0x20
+HEADER = struct.Struct('>BI')
+
+
+def _bits(data, length):
+    return [bit == '1' for bit in bin(int.from_bytes(data, 'big'))[2:].zfill(len(data) * 8)[:length]]
+
+
+def unpack_board(data):
+    data = bytes(data)
+    version, size = HEADER.unpack_from(data)
+    length = size * size
+    bitmap_length = (length + 7) // 8
+    offset = HEADER.size
+    mines = _bits(data[offset:offset + bitmap_length], length)
+    revealed = _bits(data[offset + bitmap_length:offset + 2 * bitmap_length], length)
+    counts = data[offset + 2 * bitmap_length:].hex()[:length]
+    cells = [int(count, 16) | (MINE_FLAG if mine else 0) | (REVEALED_FLAG if shown else 0)
+             for mine, shown, count in zip(mines, revealed, counts)]
+    return size, cells
+
+
+def count_boards(apps, schema_editor):
+    Game = apps.get_model('games', 'Game')
+
+    games = Game.objects.filter(packed_board__isnull=False).values_list('pk', 'packed_board', 'is_active')
+    for pk, packed_board, is_active in games.iterator():
+        size, cells = unpack_board(packed_board)
+        empty_left = any(not cell & (MINE_FLAG | REVEALED_FLAG) for cell in cells)
+        status = 'active' if is_active else 'lost' if empty_left else 'won'
+        Game.objects.filter(pk=pk).update(
+            mine_count=sum(1 for cell in cells if cell & MINE_FLAG),
+            revealed_count=sum(1 for cell in cells if cell & REVEALED_FLAG),
+            status=status,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0005_precompute_board_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='mark_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='mine_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='revealed_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='status',
+            field=models.CharField(choices=[('active', 'Active'), ('won', 'Won'), ('lost', 'Lost')], default='active', max_length=6),
+        ),
+        migrations.RunPython(count_boards, migrations.RunPython.noop),
+    ]
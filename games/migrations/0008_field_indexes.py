@@ -0,0 +1,63 @@
+from django.db import migrations
+
+# Field rows, by id, deduplicated per statement
+DEDUPE_BATCH_ROWS = 50000
+
+INDEXES = [
+    ('games_field_game_x_y_uniq', 'UNIQUE INDEX {concurrently} games_field_game_x_y_uniq ON games_field (game_id, x, y)'),
+    ('games_field_mines_idx', "INDEX {concurrently} games_field_mines_idx ON games_field (game_id) WHERE symbol = 'M'"),
+    ('games_field_empties_idx', "INDEX {concurrently} games_field_empties_idx ON games_field (game_id) WHERE symbol = 'E'"),
+]
+
+
+# Keeps the first row of every (game, x, y). Batches are ranges of ids so a statement never
+# handles more than DEDUPE_BATCH_ROWS rows whatever the board sizes, the first rows are looked
+# up among all the rows of the games of the range. Each batch commits on its own so the table
+# is never locked as a whole
+def dedupe_fields(apps, schema_editor):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT MIN(id), MAX(id) FROM games_field')
+        first, last = cursor.fetchone()
+        if first is None:
+            return
+
+        for start in range(first, last + 1, DEDUPE_BATCH_ROWS):
+            stop = start + DEDUPE_BATCH_ROWS
+            cursor.execute(
+                'DELETE FROM games_field WHERE id >= %s AND id < %s AND id NOT IN '
+                '(SELECT MIN(id) FROM games_field WHERE game_id IN '
+                '(SELECT game_id FROM games_field WHERE id >= %s AND id < %s) GROUP BY game_id, x, y)',
+                [start, stop, start, stop])
+
+
+# Postgres builds the indexes without blocking writes, an interrupted build leaves an invalid
+# index behind that is dropped before trying again
+def create_indexes(apps, schema_editor):
+    concurrently = 'CONCURRENTLY' if schema_editor.connection.vendor == 'postgresql' else ''
+    for name, sql in INDEXES:
+        schema_editor.execute('DROP INDEX {} IF EXISTS {}'.format(concurrently, name))
+        schema_editor.execute('CREATE ' + sql.format(concurrently=concurrently))
+
+
+def drop_indexes(apps, schema_editor):
+    concurrently = 'CONCURRENTLY' if schema_editor.connection.vendor == 'postgresql' else ''
+    for name, sql in INDEXES:
+        schema_editor.execute('DROP INDEX {} IF EXISTS {}'.format(concurrently, name))
+
+
+class Migration(migrations.Migration):
+    # Concurrent index builds can not run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('games', '0007_game_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_fields, migrations.RunPython.noop, atomic=False),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(create_indexes, drop_indexes, atomic=False)],
+            state_operations=[migrations.AlterUniqueTogether(name='field', unique_together={('game', 'x', 'y')})],
+        ),
+    ]
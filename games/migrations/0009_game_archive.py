@@ -0,0 +1,27 @@
+# Generated by Django 2.1.11 on 2026-10-18 20:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0008_field_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameArchive',
+            fields=[
+                ('game', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive', serialize=False, to='games.Game')),
+                ('packed_board', models.BinaryField()),
+                ('archive_date', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='is_archived',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 2.1.11 on 2026-10-18 20:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0009_game_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BoardTile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tx', models.IntegerField()),
+                ('ty', models.IntegerField()),
+                ('revealed', models.BinaryField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='seed',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='tile_size',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='boardtile',
+            name='game',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tiles', to='games.Game'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='boardtile',
+            unique_together={('game', 'tx', 'ty')},
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.1.11 on 2026-10-18 21:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Boards of existing games already include all their marks
+def snapshot_existing_boards(apps, schema_editor):
+    Game = apps.get_model('games', 'Game')
+    Game.objects.update(snapshot_move=models.F('mark_count'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0010_tiled_boards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameMove',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField()),
+                ('x', models.IntegerField()),
+                ('y', models.IntegerField()),
+                ('outcome', models.PositiveSmallIntegerField(choices=[(0, 'clear'), (1, 'superclear'), (2, 'dead'), (3, 'win')])),
+            ],
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='snapshot_move',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(snapshot_existing_boards, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='gamemove',
+            name='game',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='moves', to='games.Game'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='gamemove',
+            unique_together={('game', 'number')},
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.1.11 on 2026-10-18 21:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0011_move_log'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PooledBoard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.IntegerField()),
+                ('mine_count', models.IntegerField()),
+                ('packed_board', models.BinaryField()),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='pooledboard',
+            index_together={('size', 'mine_count')},
+        ),
+    ]
@@ -1,25 +1,140 @@
+import zlib
+
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
 
 # Create your models here.
-from games.managers import FieldManager, GameManager
+from games.board import Board
+from games.cache import board_cache
+from games.managers import FieldManager, GameManager, GameArchiveManager, BoardTileManager, GameMoveManager, \
+    PooledBoardManager
+from games.tiles import TiledBoard
 
 
 class Game(models.Model):
+    ACTIVE = 'active'
+    WON = 'won'
+    LOST = 'lost'
+    STATUS_CHOICES = (
+        (ACTIVE, 'Active'),
+        (WON, 'Won'),
+        (LOST, 'Lost'),
+    )
+
     size = models.IntegerField()
     user = models.ForeignKey(User, db_column='user_id', on_delete=models.CASCADE)
     create_date = models.DateTimeField(auto_now_add=True)
     start_date = models.DateTimeField(null=True, auto_now_add=True)
     end_date = models.DateTimeField(null=True)
     is_active= models.BooleanField(default=True)
+    packed_board = models.BinaryField(null=True)
+    status = models.CharField(max_length=6, choices=STATUS_CHOICES, default=ACTIVE)
+    mine_count = models.IntegerField(default=0)
+    revealed_count = models.IntegerField(default=0)
+    mark_count = models.IntegerField(default=0)
+    version = models.IntegerField(default=0)
+    is_archived = models.BooleanField(default=False)
+    # Very big games keep their map in BoardTile rows instead of the packed board
+    tile_size = models.IntegerField(null=True)
+    seed = models.BigIntegerField(null=True)
+    # Marks already applied to the packed board, later ones are replayed from the move log
+    snapshot_move = models.IntegerField(default=0)
     objects = GameManager()
 
+    # Decoded map, loaded once per instance from the board cache or the packed column
+    @property
+    def board(self):
+        if getattr(self, '_board', None) is None:
+            self._board = board_cache.load(self)
+        return self._board
+
+    @board.setter
+    def board(self, board):
+        self._board = board
+
+    # Archived games keep their packed board compressed in their archive record, other games
+    # replay the moves played since their last snapshot
+    def unpack_board(self):
+        if self.is_tiled:
+            return TiledBoard(self.size, self.tile_size, self.seed, self.mine_count, self.tiles,
+                              getattr(settings, 'GAME_TILES_IN_MEMORY', 64))
+        if self.is_archived:
+            return Board.unpack(zlib.decompress(self.archive.packed_board))
+        board = Board.unpack(self.packed_board) if self.packed_board else Board(self.size)
+        if self.mark_count > self.snapshot_move:
+            self.moves.replay(board, self.snapshot_move, self.mark_count)
+        return board
+
+    @property
+    def is_tiled(self):
+        return self.tile_size is not None
+
+    @property
+    def safe_count(self):
+        return self.size * self.size - self.mine_count
+
+    # The decoded board is the source of truth once loaded, keep the column in sync
+    def save(self, *args, **kwargs):
+        if getattr(self, '_board', None) is not None and not self.is_archived and not self.is_tiled:
+            self.packed_board = self._board.pack()
+            self.snapshot_move = self.mark_count
+        super().save(*args, **kwargs)
+
+
+# Finished game moved out of the hot columns, see the archive_games command
+class GameArchive(models.Model):
+    game = models.OneToOneField(Game, primary_key=True, related_name='archive', on_delete=models.CASCADE)
+    packed_board = models.BinaryField()
+    archive_date = models.DateTimeField(auto_now_add=True)
+    objects = GameArchiveManager()
+
+
+# A mark played on a game, see GameMoveManager
+class GameMove(models.Model):
+    OUTCOMES = ('clear', 'superclear', 'dead', 'win')
+
+    # The (game, number) unique index covers lookups by game
+    game = models.ForeignKey(Game, related_name='moves', db_index=False, on_delete=models.CASCADE)
+    number = models.IntegerField()
+    x = models.IntegerField()
+    y = models.IntegerField()
+    outcome = models.PositiveSmallIntegerField(choices=list(enumerate(OUTCOMES)))
+    objects = GameMoveManager()
+
+    class Meta:
+        unique_together = ('game', 'number')
+
+
+# Board of a popular configuration generated ahead of time, see the fill_board_pool command
+class PooledBoard(models.Model):
+    size = models.IntegerField()
+    mine_count = models.IntegerField()
+    packed_board = models.BinaryField()
+    objects = PooledBoardManager()
+
+    class Meta:
+        index_together = ('size', 'mine_count')
+
+
+# Revealed cells of a touched tile of a tiled game, as a packed bitmap
+class BoardTile(models.Model):
+    game = models.ForeignKey(Game, related_name='tiles', on_delete=models.CASCADE)
+    tx = models.IntegerField()
+    ty = models.IntegerField()
+    revealed = models.BinaryField()
+    objects = BoardTileManager()
+
+    class Meta:
+        unique_together = ('game', 'tx', 'ty')
+
 
 class GameProxy(Game):
     class Meta:
         proxy = True
 
 
+# Per cell rows of games created before the packed board, kept for the data migration
 class Field(models.Model):
     game = models.ForeignKey(Game, db_column='game_id', on_delete=models.CASCADE)
     x = models.IntegerField()
@@ -27,6 +142,11 @@ class Field(models.Model):
     symbol = models.CharField(max_length=1, default='E')
     objects = FieldManager()    # Perform initial map generation
 
+    class Meta:
+        # Built concurrently by migration 0008, which also adds partial indexes on game for
+        # symbol 'M' and 'E' rows
+        unique_together = ('game', 'x', 'y')
+
     def is_mine(self):
         return self.symbol=='M'
 
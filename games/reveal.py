@@ -0,0 +1,101 @@
+import re
+from collections import deque
+
+from games.board import COUNT_MASK, MINE_FLAG, REVEALED_FLAG
+
+
+def _table(func):
+    return bytes(func(value) for value in range(256))
+
+
+def _is_closed(value):
+    return not value & (MINE_FLAG | REVEALED_FLAG)
+
+
+# Every cell of a row segment is turned into a marker so runs can be found with a regex:
+# 'z' closed cell without adjacent mines, 'c' closed cell with adjacent mines, '.' anything else
+MARKER_TABLE = _table(lambda value: ord('.') if not _is_closed(value) else ord('c') if value & COUNT_MASK else ord('z'))
+OPEN_TABLE = _table(lambda value: value | REVEALED_FLAG if _is_closed(value) else value)
+
+CLOSED_RUNS = re.compile(b'[zc]+')
+COUNTED_RUNS = re.compile(b'c+')
+ZERO_RUNS = re.compile(b'z+')
+NOT_ZERO = re.compile(b'[^\x00]')
+
+
+class FloodFillRevealer:
+    """
+    Reveals a cell of a board and, when it has no adjacent mines, the whole region around it.
+
+    Queue based scanline fill over the flat cell array of the board: every queued seed opens
+    the whole run of closed zero cells of its row at once, so each cell is opened exactly once
+    and whole runs are handled by byte operations instead of python loops
+    """
+
+    def __init__(self, board):
+        self.board = board
+
+    # Returns the newly revealed cells as (x, y, count) tuples
+    def reveal(self, x, y):
+        size = self.board.size
+        cells = self.board.cells
+        return [
+            (index // size, index % size, cells[index] & COUNT_MASK)
+            for start, stop in self.reveal_spans(x, y)
+            for index in range(start, stop)
+        ]
+
+    # Returns the newly revealed cells as (start, stop) ranges of flat indexes
+    def reveal_spans(self, x, y):
+        return self.reveal_indexes([self.board.index(x, y)])
+
+    # Reveals many cells at once, the regions of all of them are filled in a single pass
+    def reveal_indexes(self, indexes):
+        size = self.board.size
+        cells = self.board.cells
+        spans = []
+        queue = deque()
+        for start in indexes:
+            if not _is_closed(cells[start]):
+                continue
+            # A closed cell without flags or adjacent mines is exactly a zero byte
+            if cells[start]:
+                cells[start] |= REVEALED_FLAG
+                spans.append((start, start + 1))
+            else:
+                queue.append(start)
+
+        while queue:
+            seed = queue.popleft()
+            if cells[seed]:
+                continue
+
+            row_start = seed - seed % size
+            row_stop = row_start + size
+            left = row_start + len(cells[row_start:seed].rstrip(b'\x00'))
+            right = NOT_ZERO.search(cells, seed, row_stop)
+            right = right.start() if right else row_stop
+
+            # The run and the cells bordering it, none of them can be a mine
+            low = max(left - 1, row_start)
+            high = min(right + 1, row_stop)
+            self._open(low, high, CLOSED_RUNS, spans)
+
+            for offset in (-size, size):
+                if not 0 <= row_start + offset < len(cells):
+                    continue
+                markers = cells[low + offset:high + offset].translate(MARKER_TABLE)
+                for run in ZERO_RUNS.finditer(markers):
+                    queue.append(low + offset + run.start())
+                self._open(low + offset, high + offset, COUNTED_RUNS, spans, markers)
+
+        return spans
+
+    def _open(self, low, high, runs, spans, markers=None):
+        cells = self.board.cells
+        if markers is None:
+            markers = cells[low:high].translate(MARKER_TABLE)
+        for run in runs.finditer(markers):
+            start, stop = low + run.start(), low + run.end()
+            cells[start:stop] = cells[start:stop].translate(OPEN_TABLE)
+            spans.append((start, stop))
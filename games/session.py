@@ -0,0 +1,84 @@
+import copy
+
+from games.game import GameInteractor, GameIsNotActiveException
+
+
+class GameSession:
+    """
+    A game kept resident in memory for a long lived connection.
+
+    Marks are applied to the in memory board right away and persisted later in batches, a
+    session must be the only one playing its game until its pending marks are flushed
+    """
+    interactor = GameInteractor()
+
+    def __init__(self, game, batch_size):
+        self.game = game
+        self.batch_size = batch_size
+        self.pending_spans = []
+        self.pending_moves = []
+        if game.is_tiled:
+            # Changed tiles stay built until a flush saves them with their moves
+            game.board.autosave = False
+
+    def mark(self, x, y):
+        if not self.game.is_active:
+            raise GameIsNotActiveException("Game is not active")
+
+        status, num_bombs, revealed = self.interactor.apply_mark(self.game, x, y)
+        self.pending_spans += revealed
+        self.pending_moves.append((x, y, status))
+
+        result = {'status': status, 'mark_count': self.game.mark_count}
+        if num_bombs is not None and status != 'win':
+            result['num_bombs'] = num_bombs
+        if self.game.is_tiled:
+            result.update(self.interactor.tiled_changes(self.game, revealed))
+        elif self.game.is_active:
+            result['changes'] = self.game.board.changes(revealed)
+        else:
+            result['map'] = self.game.revealed_matrix_string
+        return result
+
+    @property
+    def should_flush(self):
+        return len(self.pending_moves) >= self.batch_size or (bool(self.pending_moves) and not self.game.is_active)
+
+    # Pending marks together with a copy of the game they lead to, for flush to save
+    def take_pending(self):
+        if not self.pending_moves:
+            return None
+
+        board = self.game.board
+        snapshot = copy.copy(self.game.gamemodel)
+        snapshot.board = board.copy()
+        tiles = set()
+        if self.game.is_tiled:
+            # The copy saves the tiles changed so far, the live board only tracks the next ones
+            tiles, board.dirty = board.dirty, set()
+            board.held = tiles
+        pending = (snapshot, self.pending_spans, self.pending_moves, tiles)
+        self.pending_spans = []
+        self.pending_moves = []
+        return pending
+
+    # Marks of a flush that failed go back in front of the ones played since, the next flush
+    # saves them all
+    def restore_pending(self, pending):
+        snapshot, spans, moves, tiles = pending
+        self.pending_spans = spans + self.pending_spans
+        self.pending_moves = moves + self.pending_moves
+        if tiles:
+            self.game.board.dirty |= tiles
+            self.game.board.held = set()
+
+    # Only one flush may run at a time, it is safe to call from another thread
+    def flush(self, pending):
+        snapshot, spans, moves, tiles = pending
+        self.interactor.save_marks(snapshot, spans, moves)
+        self.game.gamemodel.version = snapshot.version
+        self.game.gamemodel.snapshot_move = snapshot.snapshot_move
+        if self.game.is_tiled:
+            self.game.board.held = set()
+        else:
+            self.game.board.seed = snapshot.board.seed
@@ -1,12 +1,32 @@
+import io
+import os
+import random
+import subprocess
+import tempfile
+import threading
+from unittest import mock
+
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature, override_settings
+from django.test.utils import CaptureQueriesContext
 
 # Create your tests here.
-from games.game import RandomGameStarter, InvalidSizeParameterException, InvalidMinesParameterException, GameInteractor
+from games.board import Board, PACK_VERSION, SEEDED_HEADER
+from games.cache import board_cache, GameBoardCache
+from games.game import RandomGameStarter, InvalidSizeParameterException, InvalidMinesParameterException, GameInteractor, \
+    GameInformationService, GameIsNotActiveException, StaleGameException
+from games.layout import MineLayout
+from games.metrics import Registry, registry
+from games.models import Game, Field, GameArchive, BoardTile, GameMove, PooledBoard
+from games.reveal import FloodFillRevealer
+from games.session import GameSession
 
 
 class TestsCommonGenerator:
     def generate(self):
+        board_cache.clear()
         User.objects.create(username="test")
         setattr(self,'user', User.objects.get(username='test'))
 
@@ -44,3 +64,613 @@ class TestGamePlay(TestCase, TestsCommonGenerator):
         game = starter.start_game(8, 10, self.user)
         game, mark = interactor.mark(game, 5, 5)
         self.assertEqual(10, game.flag_count)
+
+
+class TestPackedBoard(TestCase, TestsCommonGenerator):
+    user = None
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def test_pack_round_trip(self):
+        board = Board(5)
+        board.set_mine(0, 0)
+        board.set_mine(4, 3)
+        board.reveal(2, 2, 0)
+        board.reveal(0, 1, 1)
+        unpacked = Board.unpack(board.pack())
+        self.assertEqual(board.cells, unpacked.cells)
+        self.assertEqual(['M1EEE', 'EEEEE', 'EE0EE', 'EEEEE', 'EEEME'], unpacked.symbol_rows())
+        self.assertEqual(['X1XXX', 'XXXXX', 'XX0XX', 'XXXXX', 'XXXXX'], unpacked.player_rows())
+
+    def test_single_mines_update_counts(self):
+        board = Board(6)
+        board.place_mines([board.index(0, 0), board.index(3, 3)])
+        board.set_mine(2, 4)
+        board.set_mine(2, 4)
+        board.clear(0, 0)
+        expected = Board(6)
+        expected.place_mines([board.index(3, 3), board.index(2, 4)])
+        self.assertEqual(expected.cells, board.cells)
+
+    def test_seeded_pack_round_trip(self):
+        packed = Board.pack_seed(30, 100, 42)
+        self.assertEqual(SEEDED_HEADER.size + 113, len(packed))
+        board = Board.unpack(packed)
+        self.assertEqual((42, Board.from_seed(30, 100, 42).cells), (board.seed, board.cells))
+
+    def test_seeded_boards_are_packed_whole(self):
+        board = Board.unpack(Board.pack_seed(9, 20, 7))
+        x, y = next((x, y) for x in range(9) for y in range(9) if not board.is_mine(x, y))
+        board.set_mine(x, y)
+        packed = board.pack()
+        self.assertEqual(PACK_VERSION, packed[0])
+        self.assertEqual(board.cells, Board.unpack(packed).cells)
+
+    def test_mine_layout(self):
+        layout = MineLayout(9, 20, 7)
+        self.assertEqual(list(range(81)), sorted(layout.permute(position) for position in range(81)))
+        mines = layout.indexes()
+        self.assertEqual(20, len(set(mines)))
+        self.assertEqual(sorted(mines), [index for index in range(81) if layout.is_mine(index)])
+        self.assertEqual(sorted(mines), sorted(MineLayout(9, 20, 7).indexes()))
+        self.assertNotEqual(sorted(mines), sorted(MineLayout(9, 20, 8).indexes()))
+
+    def test_board_is_stored_in_game_row(self):
+        starter = RandomGameStarter()
+        game = starter.start_game(8, 10, self.user)
+        stored = Game.objects.find_game_by_id(game.pk)
+        self.assertEqual(10, stored.board.mine_count())
+        self.assertEqual(game.revealed_matrix_string, GameInformationService(stored).revealed_matrix_string)
+        self.assertFalse(Field.objects.game_fields_queryset(stored).exists())
+
+    def test_mark_is_persisted(self):
+        starter = RandomGameStarter()
+        game = starter.start_game(8, 10, self.user)
+        x, y = next((x, y) for x in range(8) for y in range(8) if not game.gamemodel.board.is_mine(x, y))
+        GameInteractor().mark(game, x, y)
+        stored = Game.objects.find_game_by_id(game.pk)
+        self.assertTrue(stored.board.is_revealed(x, y))
+        self.assertEqual(game.notrevealed_matrix_string, GameInformationService(stored).notrevealed_matrix_string)
+
+    def test_dense_board_generation(self):
+        starter = RandomGameStarter()
+        game = starter.start_game(20, 399, self.user)
+        self.assertEqual(399, game.mine_count)
+        self.assertRaises(InvalidMinesParameterException, starter.start_game, size=20, mines=400, user=self.user)
+
+    def test_counts_are_precomputed(self):
+        board = Board(4)
+        board.place_mines([board.index(0, 0), board.index(1, 1), board.index(3, 3)])
+        self.assertEqual([1, 2, 1, 0], [board.count(0, y) for y in range(4)])
+        self.assertEqual([1, 1, 2, 1], [board.count(2, y) for y in range(4)])
+        self.assertEqual(1, board.count(3, 2))
+
+
+class TestFloodFillRevealer(TestCase):
+
+    def test_reveal_empty_region(self):
+        board = Board(4)
+        board.place_mines([board.index(0, 3)])
+        revealed = FloodFillRevealer(board).reveal(3, 0)
+        self.assertEqual(15, len(revealed))
+        self.assertEqual(15, len(set(revealed)))
+        self.assertIn((1, 2, 1), revealed)
+        self.assertEqual(['001M', '0011', '0000', '0000'], board.symbol_rows())
+        self.assertEqual([], FloodFillRevealer(board).reveal(3, 0))
+
+    def test_reveal_counted_cell(self):
+        board = Board(4)
+        board.place_mines([board.index(0, 3)])
+        self.assertEqual([(1, 2, 1)], FloodFillRevealer(board).reveal(1, 2))
+        self.assertEqual(['XXXX', 'XX1X', 'XXXX', 'XXXX'], board.player_rows())
+
+
+class TestBoardChangesPersistence(TestCase, TestsCommonGenerator):
+    user = None
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def test_marks_write_only_changes(self):
+        starter = RandomGameStarter()
+        game = starter.start_game(60, 300, self.user)
+        board = game.gamemodel.board
+        closed = [(x, y) for x in range(60) for y in range(60) if not board.is_mine(x, y)]
+        for x, y in closed[::97]:
+            if game.is_active and not board.is_revealed(x, y):
+                with CaptureQueriesContext(connection) as queries:
+                    GameInteractor().mark(game, x, y)
+                # Savepoint, row lock, move append, counters update and release
+                self.assertLessEqual(len(queries), 5)
+        stored = Game.objects.find_game_by_id(game.pk)
+        self.assertEqual(board.cells, stored.board.cells)
+
+
+class TestGameCounters(TestCase, TestsCommonGenerator):
+    user = None
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def test_win_is_counted(self):
+        game = RandomGameStarter().start_game(6, 5, self.user)
+        board = game.gamemodel.board
+        result = None
+        for x in range(6):
+            for y in range(6):
+                if game.is_active and not board.is_mine(x, y) and not board.is_revealed(x, y):
+                    result = GameInteractor().mark(game, x, y)
+        self.assertEqual('win', result['status'])
+        stored = Game.objects.find_game_by_id(game.pk)
+        self.assertEqual(Game.WON, stored.status)
+        self.assertFalse(stored.is_active)
+        self.assertIsNotNone(stored.end_date)
+        self.assertEqual(31, stored.revealed_count)
+        self.assertEqual(game.mark_count, stored.mark_count)
+
+    def test_dead_is_counted(self):
+        game = RandomGameStarter().start_game(6, 5, self.user)
+        x, y = next((x, y) for x in range(6) for y in range(6) if game.gamemodel.board.is_mine(x, y))
+        self.assertEqual('dead', GameInteractor().mark(game, x, y)['status'])
+        stored = Game.objects.find_game_by_id(game.pk)
+        self.assertEqual((Game.LOST, False, 1, 5), (stored.status, stored.is_active, stored.mark_count, stored.mine_count))
+        self.assertRaises(GameIsNotActiveException, GameInteractor().mark, game, x, y)
+
+
+@override_settings(GAME_SNAPSHOT_INTERVAL=3)
+class TestMoveLog(TestCase, TestsCommonGenerator):
+    user = None
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def safe_cells(self, game):
+        board = game.gamemodel.board
+        return [(x, y) for x in range(30) for y in range(30) if not board.is_mine(x, y) and board.count(x, y)]
+
+    def test_moves_are_replayed_after_snapshot(self):
+        game = RandomGameStarter().start_game(30, 200, self.user)
+        cells = self.safe_cells(game)[:4]
+        for x, y in cells:
+            GameInteractor().mark(game, x, y)
+
+        moves = list(GameMove.objects.filter(game=game.gamemodel).order_by('number').values_list('number', 'x', 'y'))
+        self.assertEqual([(number + 1, x, y) for number, (x, y) in enumerate(cells)], moves)
+        board_cache.clear()
+        stored = Game.objects.get(pk=game.pk)
+        self.assertEqual((3, 4), (stored.snapshot_move, stored.mark_count))
+        self.assertFalse(Board.unpack(stored.packed_board).is_revealed(*cells[3]))
+        self.assertEqual(game.gamemodel.board.cells, stored.board.cells)
+
+    def test_replay_stops_at_the_row_read(self):
+        game = RandomGameStarter().start_game(30, 200, self.user)
+        first, second = self.safe_cells(game)[:2]
+        GameInteractor().mark(game, *first)
+        board_cache.clear()
+        read = Game.objects.get(pk=game.pk)
+        GameInteractor().mark(game, *second)
+        self.assertTrue(read.board.is_revealed(*first))
+        self.assertFalse(read.board.is_revealed(*second))
+
+    def test_seeded_game_is_snapshot_on_first_mark(self):
+        game = Game.objects.create_many([Game(user=self.user, size=30, mine_count=200,
+                                              packed_board=Board.pack_seed(30, 200, 7))])[0]
+        game = GameInformationService(Game.objects.find_game_by_id(game.pk))
+        GameInteractor().mark(game, *self.safe_cells(game)[0])
+        stored = Game.objects.get(pk=game.pk)
+        self.assertEqual((1, PACK_VERSION), (stored.snapshot_move, bytes(stored.packed_board)[0]))
+        self.assertIsNone(game.board.seed)
+
+    def test_finished_game_is_snapshot(self):
+        game = RandomGameStarter().start_game(30, 200, self.user)
+        GameInteractor().mark(game, *self.safe_cells(game)[0])
+        x, y = next((x, y) for x in range(30) for y in range(30) if game.gamemodel.board.is_mine(x, y))
+        GameInteractor().mark(game, x, y)
+        stored = Game.objects.get(pk=game.pk)
+        self.assertEqual((2, 2), (stored.snapshot_move, stored.mark_count))
+
+    def test_export(self):
+        game = RandomGameStarter().start_game(30, 200, self.user)
+        x, y = self.safe_cells(game)[0]
+        GameInteractor().mark(game, x, y)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'moves.jsonl')
+            call_command('export_moves', game.pk, output=path)
+            with open(path) as export:
+                lines = export.read().splitlines()
+        self.assertEqual(['{{"game": {}, "number": 1, "x": {}, "y": {}, "status": "clear"}}'.format(game.pk, x, y)], lines)
+
+
+class TestGameBoardCache(TestCase, TestsCommonGenerator):
+    user = None
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def test_version_check(self):
+        cache = GameBoardCache(10, 1024)
+        game = RandomGameStarter().start_game(8, 10, self.user).gamemodel
+        stored = Game.objects.find_game_by_id(game.pk)
+        self.assertEqual(game.board.cells, cache.load(stored).cells)
+        self.assertEqual(game.board.cells, cache.load(stored).cells)
+        stored.version += 1
+        cache.load(stored)
+        stats = cache.stats()
+        self.assertEqual((1, 2, 1, 1, 64), (stats['hits'], stats['misses'], stats['stale'], stats['entries'], stats['bytes']))
+
+    def test_size_eviction(self):
+        cache = GameBoardCache(10, 200)
+        games = [Game(pk=pk, size=8, version=0) for pk in range(1, 5)]
+        for game in games:
+            cache.store(game, Board(8))
+        self.assertEqual((3, 192), (cache.stats()['entries'], cache.stats()['bytes']))
+        self.assertNotIn(1, cache.entries.keys())
+
+
+class TestGameBoardCacheWriteThrough(TransactionTestCase, TestsCommonGenerator):
+    user = None
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def test_mark_writes_through(self):
+        game = RandomGameStarter().start_game(8, 10, self.user)
+        x, y = next((x, y) for x in range(8) for y in range(8) if not game.gamemodel.board.is_mine(x, y))
+        GameInteractor().mark(game, x, y)
+        hits = board_cache.stats()['hits']
+        stored = Game.objects.find_game_by_id(game.pk)
+        self.assertTrue(stored.board.is_revealed(x, y))
+        self.assertEqual(hits + 1, board_cache.stats()['hits'])
+
+
+class TestGameSession(TestCase, TestsCommonGenerator):
+    user = None
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def safe_cells(self, game):
+        return [(x, y) for x in range(8) for y in range(8) if not game.gamemodel.board.is_mine(x, y)]
+
+    def test_marks_are_flushed_in_batches(self):
+        game = RandomGameStarter().start_game(8, 10, self.user)
+        session = GameSession(game, 2)
+        cells = self.safe_cells(game)[:2]
+        session.mark(*cells[0])
+        self.assertFalse(session.should_flush)
+        self.assertEqual(0, Game.objects.find_game_by_id(game.pk).mark_count)
+        session.mark(*cells[1])
+        self.assertTrue(session.should_flush)
+
+        session.flush(session.take_pending())
+        self.assertIsNone(session.take_pending())
+        board_cache.clear()
+        stored = Game.objects.find_game_by_id(game.pk)
+        self.assertEqual((2, 1), (stored.mark_count, stored.version))
+        self.assertEqual(game.gamemodel.board.cells, stored.board.cells)
+        self.assertEqual(1, game.version)
+
+    def test_stale_game_is_not_saved(self):
+        game = RandomGameStarter().start_game(8, 10, self.user)
+        session = GameSession(game, 10)
+        x, y = self.safe_cells(game)[0]
+        session.mark(x, y)
+        Game.objects.filter(pk=game.pk).update(version=5)
+        with self.assertRaises(StaleGameException):
+            session.flush(session.take_pending())
+        self.assertEqual(0, Game.objects.find_game_by_id(game.pk).mark_count)
+
+    def test_restored_marks_are_flushed_again(self):
+        game = RandomGameStarter().start_game(8, 10, self.user)
+        session = GameSession(game, 10)
+        cells = self.safe_cells(game)[:2]
+        session.mark(*cells[0])
+        session.restore_pending(session.take_pending())
+        session.mark(*cells[1])
+
+        session.flush(session.take_pending())
+        board_cache.clear()
+        self.assertEqual(2, Game.objects.find_game_by_id(game.pk).mark_count)
+        moves = GameMove.objects.filter(game_id=game.pk).order_by('number')
+        self.assertEqual(cells, [(move.x, move.y) for move in moves])
+
+
+class TestMetricsRegistry(TestCase):
+
+    def make_registry(self, directory=None):
+        registry = Registry(directory, dump_interval=60)
+        counter = registry.counter('test_total', 'Test counter', ['status'])
+        histogram = registry.histogram('test_seconds', 'Test histogram', [0.1, 1])
+        return registry, counter, histogram
+
+    def test_text_format(self):
+        registry, counter, histogram = self.make_registry()
+        counter.inc(status='won')
+        counter.inc(2, status='won')
+        histogram.observe(0.5)
+        histogram.observe(3)
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE test_total counter', lines)
+        self.assertIn('test_total{status="won"} 3', lines)
+        self.assertIn('test_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('test_seconds_count 2', lines)
+
+    def test_workers_are_added_up(self):
+        with tempfile.TemporaryDirectory() as directory:
+            worker, counter, histogram = self.make_registry(directory)
+            counter.inc(status='lost')
+            histogram.observe(0.05)
+            worker.dump()
+            os.rename(worker.dump_path(os.getpid()), worker.dump_path(os.getppid()))
+
+            registry, counter, histogram = self.make_registry(directory)
+            counter.inc(status='lost')
+            lines = registry.render().splitlines()
+        self.assertIn('test_total{status="lost"} 2', lines)
+        self.assertIn('test_seconds_count 1', lines)
+
+    def test_changes_after_a_dump_schedule_the_next_one(self):
+        with tempfile.TemporaryDirectory() as directory:
+            registry, counter, histogram = self.make_registry(directory)
+            counter.inc(status='won')
+            first = registry.dump_timer
+            counter.inc(status='won')
+            self.assertIs(first, registry.dump_timer)
+            registry.dump()
+            self.assertIsNone(registry.dump_timer)
+            self.assertTrue(first.finished.is_set())
+            counter.inc(status='won')
+            self.assertIsNotNone(registry.dump_timer)
+            self.assertIsNot(first, registry.dump_timer)
+            registry.close()
+
+    def test_dumps_of_exited_processes_are_removed(self):
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+        with tempfile.TemporaryDirectory() as directory:
+            worker, counter, histogram = self.make_registry(directory)
+            counter.inc(status='lost')
+            worker.dump()
+            os.rename(worker.dump_path(os.getpid()), worker.dump_path(exited.pid))
+
+            registry, counter, histogram = self.make_registry(directory)
+            counter.inc(status='won')
+            lines = registry.render().splitlines()
+            self.assertEqual(['metrics-{}.json'.format(os.getpid())], os.listdir(directory))
+        self.assertIn('test_total{status="won"} 1', lines)
+        self.assertFalse([line for line in lines if 'lost' in line])
+
+
+class TestArchiveGames(TestCase, TestsCommonGenerator):
+    user = None
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def test_finished_games_are_archived(self):
+        finished = RandomGameStarter().start_game(8, 10, self.user)
+        x, y = next((x, y) for x in range(8) for y in range(8) if finished.gamemodel.board.is_mine(x, y))
+        GameInteractor().mark(finished, x, y)
+        active = RandomGameStarter().start_game(8, 10, self.user).gamemodel
+        Field.objects.bulk_create(Field(game=game, x=x, y=y) for game in (finished.gamemodel, active)
+                                  for x in range(8) for y in range(8))
+
+        call_command('archive_games', batch_size=1, delete_chunk=10, stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(0, Field.objects.filter(game=finished.gamemodel).count())
+        self.assertEqual(64, Field.objects.filter(game=active).count())
+        self.assertEqual([finished.pk], list(GameArchive.objects.values_list('game_id', flat=True)))
+        board_cache.clear()
+        stored = Game.objects.get(pk=finished.pk)
+        self.assertTrue(stored.is_archived)
+        self.assertIsNone(stored.packed_board)
+        self.assertEqual(finished.gamemodel.board.cells, stored.board.cells)
+        self.assertEqual(finished.revealed_matrix_string, GameInformationService(stored).revealed_matrix_string)
+        self.assertFalse(Game.objects.get(pk=active.pk).is_archived)
+
+
+@override_settings(GAME_POOL_CONFIGURATIONS=[(8, 10)], GAME_POOL_DEPTH=3)
+class TestBoardPool(TestCase, TestsCommonGenerator):
+    user = None
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def test_fill_tops_up_to_depth(self):
+        PooledBoard.objects.add_boards([Board.from_seed(8, 10, 1)])
+        call_command('fill_board_pool', stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+        call_command('fill_board_pool', stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+        self.assertEqual({(8, 10): 3}, PooledBoard.objects.depths())
+        self.assertIn('minesweeper_board_pool_depth{size="8",mines="10"} 3', registry.render().splitlines())
+
+    def test_single_fill_leaves_no_dump(self):
+        stderr = io.StringIO()
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(registry, 'directory', directory):
+            call_command('fill_board_pool', stdout=open(os.devnull, 'w'), stderr=stderr)
+            self.assertEqual([], os.listdir(directory))
+        self.assertIn('Refills are only exported', stderr.getvalue())
+
+    def test_start_claims_pooled_board(self):
+        pooled = Board.from_seed(8, 10, 1)
+        PooledBoard.objects.add_boards([pooled])
+        game = RandomGameStarter().start_game(8, 10, self.user)
+        self.assertEqual(pooled.cells, game.gamemodel.board.cells)
+        self.assertEqual({}, PooledBoard.objects.depths())
+
+        # Claims write the pooled bytes to the game, generating a board would run the mine layout
+        PooledBoard.objects.add_boards([pooled])
+        with mock.patch.object(MineLayout, 'indexes', side_effect=AssertionError('layout ran')):
+            game = RandomGameStarter().start_game(8, 10, self.user)
+        self.assertEqual(pooled.pack(), bytes(Game.objects.get(pk=game.pk).packed_board))
+
+        # Empty pool falls back to a new board
+        self.assertEqual(10, RandomGameStarter().start_game(8, 10, self.user).gamemodel.board.mine_count())
+        self.assertEqual(0, PooledBoard.objects.count())
+
+
+class TestBoardPoolClaims(TransactionTestCase):
+
+    @skipUnlessDBFeature('has_select_for_update_skip_locked')
+    def test_claims_skip_locked_boards(self):
+        boards = [Board.from_seed(8, 10, seed) for seed in (1, 2)]
+        PooledBoard.objects.add_boards(boards)
+        claimed, locked, release = [], threading.Event(), threading.Event()
+
+        def hold():
+            try:
+                with transaction.atomic():
+                    claimed.append(PooledBoard.objects.claim(8, 10))
+                    locked.set()
+                    release.wait(5)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        locked.wait(5)
+        with transaction.atomic():
+            claimed.append(PooledBoard.objects.claim(8, 10))
+        release.set()
+        thread.join()
+        self.assertEqual([board.pack() for board in boards], claimed)
+
+
+@override_settings(GAME_TILED_MIN_SIZE=16, GAME_TILE_SIZE=8)
+class TestTiledBoard(TestCase, TestsCommonGenerator):
+    user = None
+
+    def setUp(self) -> None:
+        self.generate()
+
+    # Same map as a single board
+    def whole_board(self, tiled):
+        board = Board(tiled.size)
+        board.place_mines([board.index(x, y) for x in range(tiled.size) for y in range(tiled.size) if tiled.is_mine(x, y)])
+        return board
+
+    def test_tiles_match_whole_board(self):
+        game = RandomGameStarter().start_game(30, 60, self.user).gamemodel
+        tiled = game.board
+        board = self.whole_board(tiled)
+        self.assertEqual(60, board.mine_count())
+        self.assertEqual(board.rows(), tiled.window(0, 0, 30, 30).symbol_rows())
+
+        x, y = board.coordinates(board.cells.index(0))
+        expected = {index for start, stop in FloodFillRevealer(board).reveal_spans(x, y) for index in range(start, stop)}
+        revealed = {index for start, stop in tiled.reveal_spans(x, y) for index in range(start, stop)}
+        self.assertEqual(expected, revealed)
+        self.assertEqual(board.player_rows(), tiled.window(0, 0, 30, 30).player_rows())
+
+    def test_marks_save_touched_tiles(self):
+        game = RandomGameStarter().start_game(30, 60, self.user)
+        self.assertTrue(game.is_tiled)
+        board = self.whole_board(game.board)
+        x, y = board.coordinates(board.cells.index(0))
+        result = GameInteractor().mark(game, x, y)
+        self.assertEqual(game.revealed_count, len(result['changes']))
+
+        stored = Game.objects.find_game_by_id(game.pk)
+        self.assertEqual(game.revealed_count, stored.revealed_count)
+        self.assertEqual(game.board.window(0, 0, 30, 30).player_rows(), stored.board.window(0, 0, 30, 30).player_rows())
+        touched = {(x // 8, y // 8) for x, y, symbol in result['changes']}
+        self.assertEqual(touched, set(BoardTile.objects.filter(game_id=game.pk).values_list('tx', 'ty')))
+
+    def test_session_hands_changed_tiles_to_flush(self):
+        game = RandomGameStarter().start_game(30, 60, self.user)
+        board = self.whole_board(game.board)
+        session = GameSession(game, 10)
+        session.mark(*board.coordinates(board.cells.index(0)))
+        touched = set(game.board.dirty)
+
+        pending = session.take_pending()
+        self.assertEqual(set(), game.board.dirty)
+        session.restore_pending(pending)
+        self.assertEqual(touched, game.board.dirty)
+
+        session.flush(session.take_pending())
+        self.assertEqual(set(), game.board.dirty)
+        self.assertEqual(touched, set(BoardTile.objects.filter(game_id=game.pk).values_list('tx', 'ty')))
+
+    @override_settings(GAME_TILED_MAX_CHANGES=10)
+    def test_big_fills_send_touched_tiles(self):
+        game = RandomGameStarter().start_game(30, 10, self.user)
+        board = self.whole_board(game.board)
+        result = GameInteractor().mark(game, *board.coordinates(board.cells.index(0)))
+        self.assertNotIn('changes', result)
+        self.assertEqual(8, result['tile_size'])
+        stored = set(BoardTile.objects.filter(game_id=game.pk).values_list('tx', 'ty'))
+        self.assertEqual(sorted(stored), [tuple(position) for position in result['tiles']])
+
+    @override_settings(GAME_TILES_IN_MEMORY=2)
+    def test_fills_evict_built_tiles(self):
+        game = RandomGameStarter().start_game(30, 10, self.user)
+        board = self.whole_board(game.board)
+        x, y = board.coordinates(board.cells.index(0))
+        FloodFillRevealer(board).reveal_spans(x, y)
+        GameInteractor().mark(game, x, y)
+        self.assertLessEqual(len(game.board.tiles), 2)
+        self.assertGreater(BoardTile.objects.filter(game_id=game.pk).count(), 2)
+        stored = Game.objects.find_game_by_id(game.pk)
+        self.assertEqual(board.player_rows(), stored.board.window(0, 0, 30, 30).player_rows())
+
+    # Sessions save tiles with their moves, changed tiles stay built until a flush
+    @override_settings(GAME_TILES_IN_MEMORY=2)
+    def test_session_keeps_changed_tiles_until_flush(self):
+        game = RandomGameStarter().start_game(30, 10, self.user)
+        board = self.whole_board(game.board)
+        x, y = board.coordinates(board.cells.index(0))
+        FloodFillRevealer(board).reveal_spans(x, y)
+        session = GameSession(game, 10)
+        session.mark(x, y)
+        self.assertGreater(len(game.board.dirty), 2)
+        self.assertLessEqual(game.board.dirty, set(game.board.tiles))
+        self.assertFalse(BoardTile.objects.filter(game_id=game.pk).exists())
+
+        session.flush(session.take_pending())
+        game.board.evict(0)
+        self.assertFalse(game.board.tiles)
+        self.assertEqual(board.player_rows(), game.board.window(0, 0, 30, 30).player_rows())
+
+
+class TestConcurrentMarks(TransactionTestCase, TestsCommonGenerator):
+    user = None
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def mark_all(self, game_id, cells):
+        try:
+            for x, y in cells:
+                game = GameInformationService(Game.objects.find_game_by_id(game_id))
+                try:
+                    GameInteractor().mark(game, x, y)
+                except GameIsNotActiveException:
+                    return
+        finally:
+            connection.close()
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_marks_are_linearized(self):
+        games = [RandomGameStarter().start_game(16, 30, self.user).gamemodel for _ in range(4)]
+        threads = []
+        for game in games:
+            cells = [(x, y) for x in range(16) for y in range(16) if not game.board.is_mine(x, y)]
+            random.shuffle(cells)
+            for worker in range(4):
+                threads.append(threading.Thread(target=self.mark_all, args=(game.pk, cells[worker::4])))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        board_cache.clear()
+        for game in games:
+            stored = Game.objects.find_game_by_id(game.pk)
+            self.assertEqual(Game.WON, stored.status)
+            self.assertEqual(stored.safe_count, stored.revealed_count)
+            self.assertEqual(stored.revealed_count, stored.board.revealed_count())
+            self.assertEqual(stored.version, stored.mark_count)
+            self.assertEqual(game.board.mine_count(), stored.board.mine_count())
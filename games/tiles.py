@@ -0,0 +1,240 @@
+import itertools
+import random
+from collections import OrderedDict
+
+from games.board import Board, BoardWindow, COUNT_MASK, MINE_FLAG, REVEALED_FLAG
+from games.reveal import FloodFillRevealer
+
+
+class TiledBoard:
+    """
+    Map of a very big game split in square tiles of tile_size cells, built lazily.
+
+    Mines are never stored: the mine count is split in per tile quotas proportional to the tile
+    areas and every tile samples its quota from a random generator seeded with the game seed and
+    the tile position, so any tile can be rebuilt on its own. Only the revealed bitmaps of touched
+    tiles are kept by the store. Cells of border tiles beyond the map are padding, they are
+    revealed so a fill never runs into them.
+
+    At most max_tiles tiles are kept built, the least recently used ones are dropped as others
+    are built and the changed ones are saved to the store first. Without autosave changed tiles
+    are kept until someone else saves them, and so are the held ones a copy is saving
+    """
+
+    def __init__(self, size, tile_size, seed, mines, store, max_tiles=64):
+        self.size = size
+        self.tile_size = tile_size
+        self.seed = seed
+        self.store = store
+        self.max_tiles = max_tiles
+        self.tiles_per_side = -(-size // tile_size)
+        self.quotas = self.split_mines(mines)
+        self.tiles = OrderedDict()
+        self.mines = OrderedDict()
+        self.dirty = set()
+        self.autosave = True
+        self.held = set()
+
+    # Stratified quotas: every tile gets its share of the mines rounded down and the mines left
+    # go one each to randomly chosen tiles
+    def split_mines(self, mines):
+        areas = [self.tile_area(tx, ty) for tx in range(self.tiles_per_side) for ty in range(self.tiles_per_side)]
+        total = self.size * self.size
+        quotas = [mines * area // total for area in areas]
+        rng = random.Random('{}:quotas'.format(self.seed))
+        for tile in rng.sample(range(len(areas)), mines - sum(quotas)):
+            quotas[tile] += 1
+        return quotas
+
+    def tile_shape(self, tx, ty):
+        return (min(self.tile_size, self.size - tx * self.tile_size),
+                min(self.tile_size, self.size - ty * self.tile_size))
+
+    def tile_area(self, tx, ty):
+        height, width = self.tile_shape(tx, ty)
+        return height * width
+
+    # (x, y) of the mines of a tile relative to its corner
+    def tile_mines(self, tx, ty):
+        mines = self.mines.get((tx, ty))
+        if mines is None:
+            height, width = self.tile_shape(tx, ty)
+            rng = random.Random('{}:{}:{}'.format(self.seed, tx, ty))
+            quota = self.quotas[tx * self.tiles_per_side + ty]
+            mines = self.mines[tx, ty] = [divmod(cell, width) for cell in rng.sample(range(height * width), quota)]
+        else:
+            self.mines.move_to_end((tx, ty))
+        return mines
+
+    def tile(self, tx, ty):
+        tile = self.tiles.get((tx, ty))
+        if tile is None:
+            self.evict(self.max_tiles - 1)
+            tile = self.tiles[tx, ty] = self.build_tile(tx, ty)
+        else:
+            self.tiles.move_to_end((tx, ty))
+        return tile
+
+    # Keeps the keep most recently used tiles, the dropped ones that changed are saved so they
+    # are rebuilt as they are. Mines of far away tiles go as well
+    def evict(self, keep):
+        unsaved = set(self.held) if self.autosave else self.dirty | self.held
+        dropped = [position for position in self.tiles if position not in unsaved]
+        dropped = dropped[:max(0, len(self.tiles) - keep)]
+        if not dropped:
+            return
+        self.save_tiles(self.dirty.intersection(dropped))
+        for position in dropped:
+            del self.tiles[position]
+        while len(self.mines) > 9 * max(keep, 1):
+            self.mines.popitem(last=False)
+
+    # Counts on the tile borders need the mines of the neighbour tiles, they are laid on a board
+    # one cell bigger on every side and the tile is cut out of it
+    def build_tile(self, tx, ty):
+        side = self.tile_size
+        extended = Board(side + 2)
+        mines = []
+        for ntx in (tx - 1, tx, tx + 1):
+            for nty in (ty - 1, ty, ty + 1):
+                if not (0 <= ntx < self.tiles_per_side and 0 <= nty < self.tiles_per_side):
+                    continue
+                for x, y in self.tile_mines(ntx, nty):
+                    x, y = x + (ntx - tx) * side + 1, y + (nty - ty) * side + 1
+                    if extended.in_bounds(x, y):
+                        mines.append(extended.index(x, y))
+        extended.place_mines(mines)
+
+        stride = side + 2
+        cells = bytearray(b''.join(extended.cells[x * stride + 1:x * stride + 1 + side] for x in range(1, side + 1)))
+        height, width = self.tile_shape(tx, ty)
+        for x in range(side):
+            if x >= height:
+                cells[x * side:(x + 1) * side] = bytes([REVEALED_FLAG]) * side
+            elif width < side:
+                cells[x * side + width:(x + 1) * side] = bytes([REVEALED_FLAG]) * (side - width)
+
+        tile = Board(side, cells)
+        bitmap = self.store.load_bitmap(tx, ty)
+        if bitmap is not None:
+            tile.merge_revealed_bitmap(bitmap)
+        return tile
+
+    # Tile holding a cell and the index of the cell inside it
+    def locate(self, x, y):
+        tx, lx = divmod(x, self.tile_size)
+        ty, ly = divmod(y, self.tile_size)
+        return self.tile(tx, ty), lx * self.tile_size + ly
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.size and 0 <= y < self.size
+
+    def is_mine(self, x, y):
+        tile, index = self.locate(x, y)
+        return bool(tile.cells[index] & MINE_FLAG)
+
+    def is_revealed(self, x, y):
+        tile, index = self.locate(x, y)
+        return bool(tile.cells[index] & REVEALED_FLAG)
+
+    def count(self, x, y):
+        tile, index = self.locate(x, y)
+        return tile.cells[index] & COUNT_MASK
+
+    def count_adjacent_mines(self, x, y):
+        return self.count(x, y)
+
+    # Flood fill tile by tile: zero cells a fill reveals on the border of a tile seed the fill of
+    # the tiles next to it, only the tiles the fill reaches are built. Returns (start, stop) spans
+    # of indexes of the whole map
+    def reveal_spans(self, x, y):
+        side = self.tile_size
+        spans = []
+        pending = OrderedDict([((x // side, y // side), [(x % side) * side + y % side])])
+        while pending:
+            (tx, ty), indexes = pending.popitem(last=False)
+            tile = self.tile(tx, ty)
+            before = self.border(tile)
+            tile_spans = FloodFillRevealer(tile).reveal_indexes(indexes)
+            if not tile_spans:
+                continue
+            self.dirty.add((tx, ty))
+
+            for start, stop in tile_spans:
+                lx, ly = divmod(start, side)
+                gx, gy = tx * side + lx, ty * side + ly
+                spans.append((gx * self.size + gy, gx * self.size + gy + stop - start))
+            for index, (old, new) in zip(self.border_indexes(), zip(before, self.border(tile))):
+                # Newly revealed without adjacent mines
+                if new == REVEALED_FLAG and old != new:
+                    self.seed_neighbours(pending, tx, ty, *divmod(index, side))
+        return spans
+
+    # Cells of the four tile borders, in the order of border_indexes
+    def border(self, tile):
+        side = self.tile_size
+        cells = tile.cells
+        return cells[:side] + cells[side * (side - 1):] + cells[::side] + cells[side - 1::side]
+
+    def border_indexes(self):
+        side = self.tile_size
+        return itertools.chain(range(side), range(side * (side - 1), side * side),
+                               range(0, side * side, side), range(side - 1, side * side, side))
+
+    # Cells around a tile cell that lie in other tiles are queued for their tiles
+    def seed_neighbours(self, pending, tx, ty, lx, ly):
+        side = self.tile_size
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                nx, ny = lx + dx, ly + dy
+                if 0 <= nx < side and 0 <= ny < side:
+                    continue
+                x, y = tx * side + nx, ty * side + ny
+                if self.in_bounds(x, y):
+                    pending.setdefault((x // side, y // side), []).append((x % side) * side + y % side)
+
+    # [tx, ty] of the tiles holding the given spans of the whole map
+    def span_tiles(self, spans):
+        side = self.tile_size
+        return sorted({(start // self.size // side, start % self.size // side) for start, stop in spans})
+
+    # [x, y, symbol] of every cell in the given spans of the whole map, as the player sees them
+    def changes(self, spans):
+        changes = []
+        for start, stop in spans:
+            x, y = divmod(start, self.size)
+            tile, index = self.locate(x, y)
+            changes += [[x, y + offset, change[2]] for offset, change in enumerate(tile.changes([(index, index + stop - start)]))]
+        return changes
+
+    # Only the tiles under the rectangle are built
+    def window(self, x0, y0, height, width):
+        side = self.tile_size
+        rows = []
+        for x in range(x0, x0 + height):
+            tx, lx = divmod(x, side)
+            y = y0
+            while y < y0 + width:
+                ty, ly = divmod(y, side)
+                run = min(side - ly, y0 + width - y)
+                tile = self.tile(tx, ty)
+                rows.append(tile.cells[lx * side + ly:lx * side + ly + run])
+                y += run
+        return BoardWindow(self.size, x0, y0, height, width, b''.join(rows))
+
+    def copy(self):
+        board = TiledBoard.__new__(TiledBoard)
+        board.__dict__.update(self.__dict__)
+        board.tiles = OrderedDict((position, tile.copy()) for position, tile in self.tiles.items())
+        board.mines = OrderedDict(self.mines)
+        board.dirty = set(self.dirty)
+        board.held = set(self.held)
+        return board
+
+    # Revealed bitmaps of the given tiles, by default the ones changed since the last save, are
+    # written to the store
+    def save_tiles(self, positions=None):
+        positions = set(self.dirty if positions is None else positions)
+        length = (self.tile_size * self.tile_size + 7) // 8
+        self.store.save_bitmaps({position: self.tiles[position].revealed_bitmap(0, length) for position in positions})
+        self.dirty -= positions
@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+
+_local = threading.local()
+
+
+class Timings:
+    """
+    Named spans and database time recorded while serving one request.
+
+    Spans may nest and overlap the database time, spans with the same name are added up.
+    Instances are installed as connection.execute_wrapper to count queries
+    """
+
+    def __init__(self):
+        self.spans = OrderedDict()
+        self.queries = 0
+        self.db_time = 0.0
+
+    def add(self, name, duration):
+        self.spans[name] = self.spans.get(name, 0.0) + duration
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - started
+
+    # Server-Timing header value, durations in milliseconds
+    def header(self, total):
+        metrics = ['db;dur={:.2f};desc="{} queries"'.format(self.db_time * 1000, self.queries)]
+        metrics += ['{};dur={:.2f}'.format(name, duration * 1000) for name, duration in self.spans.items()]
+        metrics.append('total;dur={:.2f}'.format(total * 1000))
+        return ', '.join(metrics)
+
+
+# Records into new timings, or again into the given ones
+def start(timings=None):
+    _local.timings = timings if timings is not None else Timings()
+    return _local.timings
+
+
+def stop():
+    _local.timings = None
+
+
+class span:
+    """
+    Times the enclosed block into the timings of the current request, when there is none
+    it only costs an attribute lookup
+    """
+    __slots__ = ('name', 'timings', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timings = getattr(_local, 'timings', None)
+        if self.timings is not None:
+            self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            self.timings.add(self.name, time.perf_counter() - self.started)
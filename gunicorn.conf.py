@@ -0,0 +1,14 @@
+import os
+
+
+# Workers dump their metrics to METRICS_DIR as metrics-<pid>.json (see games.metrics.Registry),
+# the dump of a worker that exited is removed right away so a new worker with its pid does not
+# start from it. The master does not load django, the file name is built here
+def child_exit(server, worker):
+    directory = os.environ.get('METRICS_DIR')
+    if not directory:
+        return
+    try:
+        os.remove(os.path.join(directory, 'metrics-{}.json'.format(worker.pid)))
+    except FileNotFoundError:
+        pass
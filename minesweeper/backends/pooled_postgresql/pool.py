@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class ConnectionPool:
+    """
+    Bounded pool of psycopg2 connections shared by the threads of a worker process.
+
+    Up to size connections are kept open between requests. When all of them are busy up to
+    max_overflow more are opened and closed again once returned, past that callers wait up to
+    timeout seconds for one. Connections idle for more than check_after seconds are pinged
+    before being handed out and connections older than recycle seconds are replaced
+    """
+
+    def __init__(self, connect, size=10, max_overflow=10, timeout=30, check_after=30, recycle=3600):
+        self.connect = connect
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.check_after = check_after
+        self.recycle = recycle
+        self.pid = os.getpid()
+        self.condition = threading.Condition()
+        # (connection, opened at, returned at), the most recently returned last
+        self.idle = deque()
+        self.opened = {}
+        # Ids of the opened connections that went over size, they are closed once returned
+        self.overflow = set()
+        self.waits = 0
+        self.overflows = 0
+        self.discarded = 0
+
+    def get(self):
+        deadline = time.monotonic() + self.timeout
+        with self.condition:
+            while not self.idle and len(self.opened) >= self.size + self.max_overflow:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout("No database connection available after {} seconds".format(self.timeout))
+                self.waits += 1
+                self.condition.wait(remaining)
+            entry = self.idle.pop() if self.idle else None
+            if entry is None:
+                # Reserved until connected so concurrent callers never go over the bound
+                reservation = object()
+                self.opened[id(reservation)] = None
+                overflow = len(self.opened) > self.size
+                if overflow:
+                    self.overflows += 1
+
+        if entry is None:
+            return self.open(reservation, overflow)
+        connection, opened_at, returned_at = entry
+        if self.is_healthy(connection, opened_at, returned_at):
+            return connection
+        self.discard(connection)
+        return self.get()
+
+    def open(self, reservation, overflow):
+        try:
+            connection = self.connect()
+        except Exception:
+            with self.condition:
+                del self.opened[id(reservation)]
+                self.condition.notify()
+            raise
+        with self.condition:
+            del self.opened[id(reservation)]
+            self.opened[id(connection)] = time.monotonic()
+            if overflow:
+                self.overflow.add(id(connection))
+        return connection
+
+    def is_healthy(self, connection, opened_at, returned_at):
+        now = time.monotonic()
+        if connection.closed or now - opened_at > self.recycle:
+            return False
+        if now - returned_at <= self.check_after:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            return False
+
+    # Connections come back outside of any transaction, the ones that can not or the ones opened
+    # over size are closed
+    def put(self, connection):
+        if not connection.closed and connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                pass
+        with self.condition:
+            opened_at = self.opened.get(id(connection))
+            keep = opened_at is not None and not connection.closed and len(self.idle) < self.size and \
+                id(connection) not in self.overflow
+            if keep:
+                self.idle.append((connection, opened_at, time.monotonic()))
+                self.condition.notify()
+                return
+        self.discard(connection)
+
+    def discard(self, connection):
+        with self.condition:
+            if self.opened.pop(id(connection), None) is not None:
+                self.discarded += 1
+            self.overflow.discard(id(connection))
+            self.condition.notify()
+        if not connection.closed:
+            connection.close()
+
+    def close(self):
+        with self.condition:
+            idle, self.idle = self.idle, deque()
+        for connection, opened_at, returned_at in idle:
+            self.discard(connection)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'opened': len(self.opened),
+                'idle': len(self.idle),
+                'waits': self.waits,
+                'overflows': self.overflows,
+                'discarded': self.discarded,
+            }
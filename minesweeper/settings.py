@@ -46,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'rest.middleware.ServerTimingMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -151,9 +152,49 @@ STATICFILES_DIRS = (
 #  Add configuration for static files storage using whitenoise
 STATICFILES_STORAGE = 'whitenoise.django.GzipManifestStaticFilesStorage'
 
+# Process local cache of decoded game boards
+GAME_BOARD_CACHE_ENTRIES = 1024
+GAME_BOARD_CACHE_BYTES = 64 * 1024 * 1024
+# Django cache alias keeping the maps of finished games
+GAME_FINISHED_BOARD_CACHE = 'default'
+# Marks between two board snapshots, the marks after the last snapshot are replayed on load
+GAME_SNAPSHOT_INTERVAL = 64
+# Configurations (size, mines) the fill_board_pool command keeps GAME_POOL_DEPTH boards ready for
+GAME_POOL_CONFIGURATIONS = [(8, 10), (16, 40), (30, 99)]
+GAME_POOL_DEPTH = 100
+# Token lookups of the game endpoints are cached per process for TOKEN_CACHE_TTL seconds
+TOKEN_CACHE_ENTRIES = 10000
+TOKEN_CACHE_TTL = 60
+# Games started by a single bulk call, and written per insert
+GAME_BULK_MAX_GAMES = 100000
+GAME_BULK_BATCH_SIZE = 1000
+# Games bigger than this are split in tiles of GAME_TILE_SIZE built on demand
+GAME_TILED_MIN_SIZE = 1024
+GAME_TILE_SIZE = 256
+# Tiles a tiled board keeps built, and the most cells a mark on it sends back one by one
+GAME_TILES_IN_MEMORY = 64
+GAME_TILED_MAX_CHANGES = 10000
+# Most cells a GET viewport may ask for
+GAME_VIEWPORT_MAX_CELLS = 1000000
+# Marks played over the game socket are saved in batches
+GAME_SOCKET_BATCH_SIZE = 20
+GAME_SOCKET_FLUSH_INTERVAL = 1.0
+
+# Server-Timing headers and a log line with queries and game spans on every request
+SERVER_TIMING = os.environ.get('SERVER_TIMING') == '1'
+# With many gunicorn workers /metrics adds up the snapshots every worker writes in this directory
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_DUMP_INTERVAL = 1.0
+
 
 import dj_database_url
+# postgres-pool:// urls use the pooled backend, its connections go back to the pool after every
+# request instead of being kept by the thread
+POOLED_POSTGRESQL = 'minesweeper.backends.pooled_postgresql'
+dj_database_url.SCHEMES['postgres-pool'] = POOLED_POSTGRESQL
 prod_db  =  dj_database_url.config(conn_max_age=500)
+if prod_db.get('ENGINE') == POOLED_POSTGRESQL:
+    prod_db['CONN_MAX_AGE'] = 0
 DATABASES['default'].update(prod_db)
 
 try:
@@ -0,0 +1,78 @@
+import threading
+
+from django.test import SimpleTestCase
+from psycopg2 import extensions
+
+from minesweeper.backends.pooled_postgresql.pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class TestConnectionPool(SimpleTestCase):
+
+    def make_pool(self, **options):
+        self.connections = []
+
+        def connect():
+            self.connections.append(FakeConnection())
+            return self.connections[-1]
+        return ConnectionPool(connect, **options)
+
+    def test_connections_are_reused(self):
+        pool = self.make_pool(size=2)
+        connection = pool.get()
+        connection.status = extensions.TRANSACTION_STATUS_INTRANS
+        pool.put(connection)
+        self.assertIs(connection, pool.get())
+        self.assertEqual((1, 1), (len(self.connections), connection.rollbacks))
+
+    def test_overflow_is_closed_when_returned(self):
+        pool = self.make_pool(size=1, max_overflow=1, timeout=0.01)
+        first, second = pool.get(), pool.get()
+        self.assertRaises(PoolTimeout, pool.get)
+        pool.put(second)
+        pool.put(first)
+        self.assertEqual((1, 0), (second.closed, first.closed))
+        self.assertEqual({'opened': 1, 'idle': 1, 'waits': 1, 'overflows': 1, 'discarded': 1}, pool.stats())
+
+    def test_base_connections_are_kept_while_overflow_is_out(self):
+        pool = self.make_pool(size=1, max_overflow=1)
+        first, second = pool.get(), pool.get()
+        pool.put(first)
+        self.assertIs(first, pool.get())
+        pool.put(first)
+        pool.put(second)
+        self.assertEqual((0, 1), (first.closed, second.closed))
+        self.assertEqual({'opened': 1, 'idle': 1, 'waits': 0, 'overflows': 1, 'discarded': 1}, pool.stats())
+
+    def test_waiters_get_returned_connections(self):
+        pool = self.make_pool(size=1, max_overflow=0, timeout=5)
+        connection = pool.get()
+        taken = []
+        thread = threading.Thread(target=lambda: taken.append(pool.get()))
+        thread.start()
+        pool.put(connection)
+        thread.join()
+        self.assertEqual([connection], taken)
+
+    def test_unhealthy_connections_are_replaced(self):
+        pool = self.make_pool(size=1, recycle=0)
+        connection = pool.get()
+        pool.put(connection)
+        self.assertIsNot(connection, pool.get())
+        self.assertEqual(1, connection.closed)
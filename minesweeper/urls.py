@@ -25,8 +25,11 @@ from rest import views
 urlpatterns = [
     path('admin/', admin.site.urls),
     path(r'api/v1/games/<int:game_id>', views.GameInteractionView.as_view()),
+    path(r'api/v1/games/<int:game_id>/marks', views.GameMarksView.as_view()),
+    path(r'api/v1/games/bulk', views.GamesBulkView.as_view()),
     url(r'^api/v1/games', views.GamesView.as_view()),
     url(r'^api/v1/users', views.UsersView.as_view()),
     url(r'api/v1/docs$', schema_view),
+    path('metrics', views.MetricsView.as_view()),
     url(r'^api-token-auth/', authviews.obtain_auth_token),
 ]
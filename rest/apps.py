@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class RestConfig(AppConfig):
     name = 'rest'
+
+    # Connects the receivers that keep the token cache in sync
+    def ready(self):
+        from rest import signals
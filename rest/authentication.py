@@ -0,0 +1,86 @@
+import threading
+import time
+
+from django.conf import settings
+from lru import LRU
+from rest_framework.authentication import TokenAuthentication
+
+
+class TokenCache:
+    """
+    Process local LRU of token keys to their (user, token), kept for ttl seconds.
+
+    Tokens deleted and users saved or deleted in this process are dropped right away, other
+    workers see those changes once their entries expire
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = LRU(max_entries)
+        self.entries.set_callback(self.evicted)
+        # Cached keys of every user pk, so saving a user does not go through the whole cache
+        self.user_keys = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] > time.monotonic():
+                self.hits += 1
+                return entry[0], entry[1]
+            if entry is not None:
+                del self.entries[key]
+                self.evicted(key, entry)
+            self.misses += 1
+            return None
+
+    def store(self, key, user, token):
+        with self.lock:
+            self.entries[key] = (user, token, time.monotonic() + self.ttl)
+            self.user_keys.setdefault(user.pk, set()).add(key)
+
+    # Also called by the LRU for the entries it drops, the lock is held
+    def evicted(self, key, entry):
+        keys = self.user_keys.get(entry[0].pk)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.user_keys[entry[0].pk]
+
+    def invalidate(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                del self.entries[key]
+                self.evicted(key, entry)
+
+    def invalidate_user(self, pk):
+        with self.lock:
+            for key in self.user_keys.pop(pk, ()):
+                if key in self.entries:
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.user_keys.clear()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """ TokenAuthentication that only looks tokens up in the database when they are not in token_cache """
+
+    cache = None
+
+    def authenticate_credentials(self, key):
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        user, token = super().authenticate_credentials(key)
+        self.cache.store(key, user, token)
+        return user, token
+
+
+token_cache = TokenCache(getattr(settings, 'TOKEN_CACHE_ENTRIES', 10000), getattr(settings, 'TOKEN_CACHE_TTL', 60))
+CachedTokenAuthentication.cache = token_cache
@@ -0,0 +1,136 @@
+import json
+import platform
+import threading
+import time
+
+import django
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import RequestFactory
+
+from games.game import RandomGameStarter
+from users.services import UserCreation
+
+ENGINES = {
+    'plain': 'django.db.backends.postgresql_psycopg2',
+    'pooled': 'minesweeper.backends.pooled_postgresql',
+}
+OPERATIONS = ['get', 'mark']
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class Command(BaseCommand):
+    help = 'Measures requests per second of the game endpoints through the whole django stack, opening a ' \
+           'postgres connection per request and taking it from the pooled backend'
+
+    game_starter = RandomGameStarter()
+    user_creation = UserCreation()
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', nargs='+', choices=sorted(ENGINES), default=['plain', 'pooled'])
+        parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=OPERATIONS)
+        parser.add_argument('--threads', type=int, default=4, help='Concurrent clients, like gthread workers')
+        parser.add_argument('--requests', type=int, default=500, help='Requests per client')
+        parser.add_argument('--pool-size', type=int, help='Pool size of the pooled mode, --threads by default')
+        parser.add_argument('--output', help='Path of the json report')
+
+    def handle(self, *args, **options):
+        database = connections.databases['default']
+        if database['ENGINE'] not in ENGINES.values():
+            raise CommandError('The default database must be postgres, it is {}'.format(database['ENGINE']))
+
+        user, token = self.user_creation.create_user('', '', 'bench-requests-{}'.format(time.time()), '', 'secret')
+        games = [self.game_starter.start_game(8, 10, user) for _ in range(options['threads'])]
+        original = dict(database)
+        results = []
+        try:
+            for mode in options['modes']:
+                self.configure(database, original, mode, options['pool_size'] or options['threads'])
+                for operation in options['operations']:
+                    results.append(self.bench(mode, operation, games, token.key, options['requests']))
+        finally:
+            self.configure(database, original, None, None)
+            # Games go away with their user
+            user.delete()
+
+        report = {
+            'meta': {
+                'threads': options['threads'],
+                'requests': options['requests'],
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            },
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+
+        self.stdout.write('{:>8} {:>10} {:>10} {:>9} {:>9} {:>7}'.format(
+            'mode', 'operation', 'req/s', 'p50 (ms)', 'p99 (ms)', 'errors'))
+        for result in results:
+            self.stdout.write('{mode:>8} {operation:>10} {requests_per_second:>10.1f} {p50_ms:>9.2f} '
+                              '{p99_ms:>9.2f} {errors:>7}'.format(**result))
+
+    # Every client thread builds its own connection from the settings of the mode, connections are
+    # closed at the end of every request like with CONN_MAX_AGE 0
+    def configure(self, database, original, mode, pool_size):
+        connections['default'].close()
+        del connections['default']
+        database.clear()
+        database.update(original)
+        if mode is None:
+            return
+        options = {key: value for key, value in original.get('OPTIONS', {}).items() if not key.startswith('pool_')}
+        if mode == 'pooled':
+            options['pool_size'] = pool_size
+        database.update(ENGINE=ENGINES[mode], CONN_MAX_AGE=0, OPTIONS=options)
+
+    def bench(self, mode, operation, games, token, requests):
+        handler = WSGIHandler()
+        factory = RequestFactory(HTTP_HOST='localhost', HTTP_AUTHORIZATION='Token ' + token)
+        samples = []
+        errors = []
+
+        def client(game):
+            x, y = next((x, y) for x in range(8) for y in range(8) if not game.gamemodel.board.is_mine(x, y))
+            times = []
+            for _ in range(requests):
+                if operation == 'get':
+                    request = factory.get('/api/v1/games/{}'.format(game.pk))
+                else:
+                    request = factory.put('/api/v1/games', json.dumps({'game_id': game.pk, 'x': x, 'y': y}),
+                                          content_type='application/json')
+                started = time.perf_counter()
+                response = handler(request.environ, lambda status, headers: None)
+                b''.join(response)
+                response.close()
+                times.append(time.perf_counter() - started)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+            samples.extend(times)
+            connections['default'].close()
+
+        threads = [threading.Thread(target=client, args=(game,)) for game in games]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        return {
+            'mode': mode,
+            'operation': operation,
+            'requests': len(samples),
+            'errors': len(errors),
+            'requests_per_second': len(samples) / elapsed,
+            'p50_ms': percentile(samples, 0.5) * 1000,
+            'p99_ms': percentile(samples, 0.99) * 1000,
+        }
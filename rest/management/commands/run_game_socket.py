@@ -0,0 +1,25 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from rest.sockets import GameSocketServer
+
+
+class Command(BaseCommand):
+    help = 'Runs the websocket endpoint to play games with the board kept in memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'GAME_SOCKET_BATCH_SIZE', 20),
+                            help='Marks saved together in one transaction')
+        parser.add_argument('--flush-interval', type=float, default=getattr(settings, 'GAME_SOCKET_FLUSH_INTERVAL', 1.0),
+                            help='Seconds between saves of pending marks')
+
+    def handle(self, *args, **options):
+        loop = asyncio.get_event_loop()
+        server = GameSocketServer(options['batch_size'], options['flush_interval'], loop)
+        loop.run_until_complete(server.serve(options['host'], options['port']))
+        self.stdout.write('Game socket listening on {}:{}'.format(options['host'], options['port']))
+        loop.run_forever()
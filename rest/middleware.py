@@ -0,0 +1,72 @@
+import json
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from games import timing
+
+logger = logging.getLogger(__name__)
+
+
+class ServerTimingMiddleware:
+    """
+    Reports query count, database time and the spans of the game hot paths of every request
+    in a Server-Timing header and a json log line.
+
+    Only enabled with the SERVER_TIMING setting, otherwise django drops it from the stack
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'SERVER_TIMING', False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = timing.start()
+        started = time.perf_counter()
+        try:
+            with self.wrap_connections(timings):
+                response = self.get_response(request)
+        finally:
+            timing.stop()
+
+        # Streamed bodies are produced after the headers are sent, their work is only logged
+        if response.streaming:
+            response.streaming_content = self.stream(request, response, response.streaming_content, timings, started)
+            return response
+        total = time.perf_counter() - started
+        response['Server-Timing'] = timings.header(total)
+        self.log(request, response, timings, total)
+        return response
+
+    def stream(self, request, response, content, timings, started):
+        timing.start(timings)
+        try:
+            with self.wrap_connections(timings):
+                yield from content
+        finally:
+            timing.stop()
+            self.log(request, response, timings, time.perf_counter() - started)
+
+    @staticmethod
+    def wrap_connections(timings):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(timings))
+        return stack
+
+    @staticmethod
+    def log(request, response, timings, total):
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': timings.queries,
+            'db_ms': round(timings.db_time * 1000, 2),
+            'spans_ms': {name: round(duration * 1000, 2) for name, duration in timings.spans.items()},
+            'total_ms': round(total * 1000, 2),
+        }))
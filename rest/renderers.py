@@ -0,0 +1,93 @@
+import re
+import struct
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from games.board import BoardWindow
+
+RUNS = re.compile(r'(.)\1*')
+
+
+class BoardRenderer(BaseRenderer):
+    """
+    Base for renderers of a game map built straight from the packed board.
+
+    Views put the Board itself under 'board' when the accepted renderer has renders_board and
+    set 'revealed' to show the whole map, anything else, like error responses, is rendered as plain json
+    and the response Content-Type says so
+    """
+    renders_board = True
+    json_renderer = JSONRenderer()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, dict) or 'board' not in data:
+            response = (renderer_context or {}).get('response')
+            if response is not None:
+                response['Content-Type'] = self.json_renderer.media_type
+            return self.json_renderer.render(data, renderer_context=renderer_context)
+        return self.render_board(data)
+
+    # The json the view would have returned, with every map row passed through encode_row
+    def render_board(self, data):
+        board = data['board']
+        rows = board.symbol_rows() if data.get('revealed') else board.player_rows()
+        information = {key: value for key, value in data.items() if key not in ('board', 'revealed')}
+        information['map'] = [self.encode_row(row) for row in rows]
+        return self.json_renderer.render(information)
+
+    def encode_row(self, row):
+        return row
+
+
+class RunLengthBoardRenderer(BoardRenderer):
+    """
+    Json with every map row run length encoded as comma separated runs of one symbol followed
+    by how many times it repeats, e.g. "X5,1,X3" (a missing count means 1)
+    """
+    media_type = 'application/vnd.minesweeper.rle+json'
+    format = 'rle'
+    charset = None
+
+    def encode_row(self, row):
+        runs = []
+        for run in RUNS.finditer(row):
+            length = run.end() - run.start()
+            runs.append(run.group(1) if length == 1 else run.group(1) + str(length))
+        return ','.join(runs)
+
+
+class BinaryBoardRenderer(BoardRenderer):
+    """
+    Packed frame: magic, format version, size, board version, mine count, status, followed
+    by 4 bits per cell row by row: the count of revealed cells and 0xF for hidden ones, or for
+    revealed maps 0xD for mines and 0xE for hidden cells.
+
+    Viewports of a map use format version 2, the header goes on with x0, y0, rows and columns
+    of the rectangle
+    """
+    media_type = 'application/vnd.minesweeper.board'
+    format = 'board'
+    charset = None
+    render_style = 'binary'
+
+    MAGIC = b'MSWB'
+    FRAME_VERSION = 1
+    WINDOW_FRAME_VERSION = 2
+    HEADER = struct.Struct('>4sBIIIB')
+    WINDOW_HEADER = struct.Struct('>IIII')
+    STATUSES = ('active', 'won', 'lost')
+
+    def render_board(self, data):
+        board = data['board']
+        window = isinstance(board, BoardWindow)
+        header = self.HEADER.pack(
+            self.MAGIC,
+            self.WINDOW_FRAME_VERSION if window else self.FRAME_VERSION,
+            board.size,
+            data.get('version', 0),
+            data.get('mine_count', 0),
+            self.STATUSES.index(data.get('status', 'active')),
+        )
+        if window:
+            header += self.WINDOW_HEADER.pack(board.x0, board.y0, board.height, board.width)
+        return header + (board.symbol_nibbles() if data.get('revealed') else board.player_nibbles())
@@ -0,0 +1,20 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from rest.authentication import token_cache
+
+
+# Rotating a token deletes the old one, deleting a user deletes its tokens
+@receiver(post_delete, sender=Token)
+def forget_token(sender, instance, **kwargs):
+    token_cache.invalidate(instance.key)
+
+
+# Deactivated users must not keep authenticating from the cache, logins only update last_login
+@receiver(post_save, sender=get_user_model())
+def forget_user_tokens(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    token_cache.invalidate_user(instance.pk)
@@ -0,0 +1,202 @@
+import asyncio
+import json
+import logging
+
+import websockets
+from django.db import close_old_connections
+from rest_framework.authtoken.models import Token
+
+from games.game import GameInformationService, GameIsNotActiveException, InvalidMarkParameterException, \
+    StaleGameException
+from games.models import Game
+from games.session import GameSession
+
+logger = logging.getLogger(__name__)
+
+# Close codes sent when a connection can not go on
+UNAUTHORIZED = 4001
+STALE_GAME = 4009
+
+
+def log_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('Game socket task failed', exc_info=task.exception())
+
+
+class GameSocketServer:
+    """
+    Websocket endpoint to play games without a request per mark.
+
+    The client authenticates once sending {"token": key}, then opens a game with
+    {"action": "open", "game_id": id} and marks it with {"action": "mark", "x": x, "y": y}.
+    Every mark is answered with the changed cells, the board stays in memory and marks are
+    saved in batches of batch_size or every flush_interval seconds
+    """
+    token_manager = Token.objects
+    game_manager = Game.objects
+
+    def __init__(self, batch_size, flush_interval, loop=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.loop = loop or asyncio.get_event_loop()
+
+    def serve(self, host, port):
+        return websockets.serve(self.handler, host, port, loop=self.loop)
+
+    async def handler(self, websocket, path):
+        user = await self.authenticate(websocket)
+        if user is None:
+            return
+
+        connection = GameConnection(self, websocket)
+        flusher = asyncio.ensure_future(connection.flush_periodically(), loop=self.loop)
+        try:
+            while True:
+                await connection.receive(user, await websocket.recv())
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            flusher.cancel()
+            await connection.flush()
+
+    async def authenticate(self, websocket):
+        try:
+            message = json.loads(await websocket.recv())
+            token = await self.database(self.token_manager.select_related('user').get, key=message['token'])
+        except (ValueError, TypeError, KeyError, Token.DoesNotExist):
+            token = None
+        # Same rule as TokenAuthentication
+        if token is None or not token.user.is_active:
+            await websocket.close(UNAUTHORIZED, 'Invalid token')
+            return None
+        await websocket.send(json.dumps({'message': "Authenticated"}))
+        return token.user
+
+    # Database work runs on the default executor, never on the event loop
+    async def database(self, func, *args, **kwargs):
+        def run():
+            close_old_connections()
+            return func(*args, **kwargs)
+        return await self.loop.run_in_executor(None, run)
+
+
+class GameConnection:
+    """ State of one websocket connection: the open game session and its pending flushes """
+
+    def __init__(self, server, websocket):
+        self.server = server
+        self.websocket = websocket
+        self.session = None
+        self.flush_lock = asyncio.Lock(loop=server.loop)
+        self.board_lock = asyncio.Lock(loop=server.loop)
+
+    async def receive(self, user, message):
+        try:
+            data = json.loads(message)
+            action = data['action']
+            if action == 'open':
+                await self.open(user, int(data['game_id']))
+            elif action == 'mark':
+                await self.mark(int(data['x']), int(data['y']))
+            else:
+                await self.send({'messages': "Unknown action {}".format(action)})
+        except (ValueError, TypeError, KeyError) as e:
+            await self.send({'messages': str(e)})
+        except (GameIsNotActiveException, InvalidMarkParameterException) as e:
+            await self.send({'messages': str(e)})
+        except Game.DoesNotExist:
+            await self.send({'messages': "Game does not exist"})
+
+    async def open(self, user, game_id):
+        await self.flush()
+        game = await self.server.database(self.load_game, game_id)
+        if game.user_id != user.pk:
+            raise Game.DoesNotExist()
+
+        self.session = GameSession(GameInformationService(game), self.server.batch_size)
+        information = self.session.game
+        opened = {
+            'game_id': information.pk,
+            'mine_count': information.mine_count,
+            'mark_count': information.mark_count,
+            'status': information.status,
+        }
+        # Tiled games are too big to send whole, marks send back their changes
+        if not information.is_tiled:
+            opened['map'] = information.notrevealed_matrix_string
+        await self.send({'message': "Game opened", 'tx': opened})
+
+    def load_game(self, game_id):
+        game = self.server.game_manager.find_game_by_id(game_id)
+        # Decode the board here, off the event loop
+        game.board
+        return game
+
+    async def mark(self, x, y):
+        if self.session is None:
+            raise KeyError('game_id')
+        if self.session.game.is_tiled:
+            # Tiles reached by the mark are built from the database, off the event loop
+            async with self.board_lock:
+                result = await self.server.database(self.session.mark, x, y)
+        else:
+            result = self.session.mark(x, y)
+        await self.send({'message': "Game marked", 'tx': result})
+        if self.session.should_flush:
+            asyncio.ensure_future(self.flush(), loop=self.server.loop).add_done_callback(log_failure)
+
+    async def flush(self):
+        async with self.flush_lock:
+            session = self.session
+            if session is None:
+                return
+            # A tiled mark may be changing the board in a thread, it is copied between marks
+            async with self.board_lock:
+                pending = session.take_pending()
+            if pending is None:
+                return
+
+            # The save goes on in its thread when the flush is cancelled, the lock keeps the next
+            # flush out until it ends
+            save = asyncio.ensure_future(self.server.database(session.flush, pending), loop=self.server.loop)
+            cancelled = False
+            while not save.done():
+                try:
+                    await asyncio.wait([save], loop=self.server.loop)
+                except asyncio.CancelledError:
+                    cancelled = True
+            await self.saved(session, pending, save.exception())
+            if cancelled:
+                raise asyncio.CancelledError()
+
+    # Marks were acknowledged before being saved: the ones of a failed flush are saved with the
+    # next one, when the game was changed elsewhere the client is told which ones are lost
+    async def saved(self, session, pending, error):
+        if isinstance(error, StaleGameException):
+            logger.warning(str(error))
+            self.session = None
+            await self.close_stale(str(error), pending[2] + session.pending_moves)
+        elif error is not None:
+            logger.error('Saving marks of game %s failed', session.game.pk, exc_info=error)
+            async with self.board_lock:
+                session.restore_pending(pending)
+
+    async def close_stale(self, reason, moves):
+        unsaved = [[x, y] for x, y, status in moves]
+        try:
+            await self.send({'messages': reason, 'tx': {'unsaved_marks': unsaved}})
+        except websockets.ConnectionClosed:
+            pass
+        # Close reasons are limited to 123 bytes, the message above has every unsaved mark
+        reason = '{} marks not saved: {}'.format(len(unsaved), ' '.join('{},{}'.format(x, y) for x, y in unsaved))
+        if len(reason.encode()) > 123:
+            reason = '{} marks not saved'.format(len(unsaved))
+        await self.websocket.close(STALE_GAME, reason)
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.server.flush_interval, loop=self.server.loop)
+            await self.flush()
+
+    async def send(self, data):
+        await self.websocket.send(json.dumps(data))
@@ -1,3 +1,418 @@
-from django.test import TestCase
+import json
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection, DatabaseError
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 # Create your tests here.
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from games.board import Board
+from games.cache import board_cache
+from games.metrics import REQUEST_SECONDS
+from games.models import Game
+from rest.authentication import token_cache, TokenCache
+from rest.renderers import BoardRenderer, RunLengthBoardRenderer, BinaryBoardRenderer
+from users.services import UserCreation
+
+
+class TestsCommonClient:
+    def generate(self):
+        board_cache.clear()
+        token_cache.clear()
+        user, token = UserCreation().create_user('', '', 'test', '', 'secret')
+        setattr(self, 'user', user)
+        setattr(self, 'client', APIClient())
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+    def start_game(self, size=8, mines=10):
+        response = self.client.post('/api/v1/games', {'size': size, 'mines': mines}, format='json')
+        return Game.objects.find_game_by_id(response.data['tx']['game_id'])
+
+    def safe_cell(self, game):
+        return next((x, y) for x in range(game.size) for y in range(game.size) if not game.board.is_mine(x, y))
+
+
+class TestGamesView(TestCase, TestsCommonClient):
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def test_mark_full_map(self):
+        game = self.start_game()
+        x, y = self.safe_cell(game)
+        response = self.client.put('/api/v1/games', {'game_id': game.pk, 'x': x, 'y': y}, format='json')
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(8, len(response.data['tx']['map']))
+
+    # A wall of mines on column 4, marking a corner opens the four columns before it
+    def test_mark_delta(self):
+        game = self.start_game()
+        game.board = Board(8)
+        game.board.place_mines([game.board.index(x, 4) for x in range(8)])
+        Game.objects.save_board(game)
+        response = self.client.put('/api/v1/games?map=delta', {'game_id': game.pk, 'x': 0, 'y': 0}, format='json')
+        result = response.data['tx']
+        self.assertEqual('superclear', result['status'])
+        self.assertNotIn('map', result)
+        self.assertEqual(32, len(result['changes']))
+        self.assertIn([0, 0, '0'], result['changes'])
+        self.assertIn([0, 3, '2'], result['changes'])
+        self.assertIn([3, 3, '3'], result['changes'])
+        stored = Game.objects.find_game_by_id(game.pk)
+        self.assertEqual((32, stored.version), (stored.revealed_count, result['version']))
+
+    # Another request ends the game between the load and the row lock
+    def test_mark_game_finished_under_lock(self):
+        game = self.start_game()
+        finished = Game.objects.find_game_by_id(game.pk)
+        finished.is_active = False
+        finished.status = Game.LOST
+        finished.version += 1
+        with mock.patch('games.managers.GameManager.find_game_for_update', return_value=finished):
+            response = self.client.put('/api/v1/games', {'game_id': game.pk, 'x': 0, 'y': 0}, format='json')
+        self.assertEqual(412, response.status_code)
+        self.assertEqual(0, Game.objects.find_game_by_id(game.pk).mark_count)
+
+    def test_mark_missing_game(self):
+        response = self.client.put('/api/v1/games', {'game_id': 0, 'x': 0, 'y': 0}, format='json')
+        self.assertEqual(412, response.status_code)
+
+
+class TestGameInteractionView(TestCase, TestsCommonClient):
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def test_json_is_default(self):
+        game = self.start_game()
+        response = self.client.get('/api/v1/games/{}'.format(game.pk))
+        self.assertEqual('application/json', response['Content-Type'])
+        self.assertEqual(['XXXXXXXX'] * 8, response.data['map'])
+
+    def test_run_length_rows(self):
+        game = self.start_game()
+        y = next(y for y in range(1, 7) if not game.board.is_mine(0, y))
+        count = game.board.count(0, y)
+        game.board.reveal(0, y, count)
+        Game.objects.save_board(game)
+        response = self.client.get('/api/v1/games/{}'.format(game.pk), HTTP_ACCEPT=RunLengthBoardRenderer.media_type)
+        self.assertEqual(RunLengthBoardRenderer.media_type, response['Content-Type'])
+        first_row = '{},{},{}'.format('X' if y == 1 else 'X{}'.format(y), count, 'X' if y == 6 else 'X{}'.format(7 - y))
+        self.assertEqual([first_row] + ['X8'] * 7, json.loads(response.content.decode())['map'])
+
+    def test_board_renderer_defaults_to_json_rows(self):
+        game = self.start_game()
+        response = self.client.get('/api/v1/games/{}'.format(game.pk))
+        board = Game.objects.find_game_by_id(game.pk).board
+        rendered = BoardRenderer().render({'board': board, 'revealed': False, 'status': 'active'})
+        self.assertEqual(json.loads(response.content.decode())['map'], json.loads(rendered.decode())['map'])
+
+    def test_binary_frame(self):
+        game = self.start_game(3, 1)
+        x, y = self.safe_cell(game)
+        game.board.reveal(x, y, game.board.count(x, y))
+        Game.objects.save_board(game)
+        response = self.client.get('/api/v1/games/{}?format=board'.format(game.pk))
+        header = BinaryBoardRenderer.HEADER
+        self.assertEqual((b'MSWB', 1, 3, 1, 1, 0), header.unpack(response.content[:header.size]))
+        nibbles = ['f'] * 10
+        nibbles[x * 3 + y] = str(game.board.count(x, y))
+        self.assertEqual(bytes.fromhex(''.join(nibbles)), response.content[header.size:])
+
+    def test_not_modified(self):
+        game = self.start_game()
+        response = self.client.get('/api/v1/games/{}'.format(game.pk))
+        etag = response['ETag']
+        self.assertEqual('"{}-0-json"'.format(game.pk), etag)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/games/{}'.format(game.pk), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual((etag, 'private, no-cache'), (response['ETag'], response['Cache-Control']))
+
+        x, y = self.safe_cell(game)
+        self.client.put('/api/v1/games', {'game_id': game.pk, 'x': x, 'y': y}, format='json')
+        response = self.client.get('/api/v1/games/{}'.format(game.pk), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('"{}-1-json"'.format(game.pk), response['ETag'])
+
+    def test_finished_game_is_cached(self):
+        game = self.start_game(3, 1)
+        x, y = next((x, y) for x in range(3) for y in range(3) if game.board.is_mine(x, y))
+        self.client.put('/api/v1/games', {'game_id': game.pk, 'x': x, 'y': y}, format='json')
+        response = self.client.get('/api/v1/games/{}'.format(game.pk))
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('M', ''.join(response.data['map']))
+        self.assertIsNotNone(caches['default'].get('games:finished-board:{}:1'.format(game.pk)))
+
+
+class TestViewport(TestCase, TestsCommonClient):
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def test_viewport_rows(self):
+        game = self.start_game(10, 10)
+        response = self.client.get('/api/v1/games/{}?viewport=2,3,4,20'.format(game.pk))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([2, 3, 4, 8], response.data['viewport'])
+        self.assertEqual([row[3:7] for row in game.board.player_rows()[2:10]], response.data['map'])
+
+    def test_viewport_binary_frame(self):
+        game = self.start_game(10, 10)
+        response = self.client.get('/api/v1/games/{}?viewport=0,0,3,2'.format(game.pk),
+                                   HTTP_ACCEPT=BinaryBoardRenderer.media_type)
+        header = BinaryBoardRenderer.HEADER.unpack_from(response.content)
+        window = BinaryBoardRenderer.WINDOW_HEADER.unpack_from(response.content, BinaryBoardRenderer.HEADER.size)
+        self.assertEqual((2, 10), header[1:3])
+        self.assertEqual((0, 0, 2, 3), window)
+        self.assertEqual(3, len(response.content) - BinaryBoardRenderer.HEADER.size - BinaryBoardRenderer.WINDOW_HEADER.size)
+
+    def test_invalid_viewport(self):
+        game = self.start_game(10, 10)
+        response = self.client.get('/api/v1/games/{}?viewport=10,0,1,1'.format(game.pk))
+        self.assertEqual(412, response.status_code)
+
+    def test_errors_are_json_for_board_formats(self):
+        game = self.start_game(10, 10)
+        for media_type in (BinaryBoardRenderer.media_type, RunLengthBoardRenderer.media_type):
+            response = self.client.get('/api/v1/games/{}?viewport=10,0,1,1'.format(game.pk), HTTP_ACCEPT=media_type)
+            self.assertEqual(412, response.status_code)
+            self.assertEqual('application/json', response['Content-Type'])
+            self.assertIn('messages', json.loads(response.content.decode()))
+
+    @override_settings(GAME_TILED_MIN_SIZE=16, GAME_TILE_SIZE=8)
+    def test_tiled_game(self):
+        response = self.client.post('/api/v1/games', {'size': 40, 'mines': 100}, format='json')
+        self.assertNotIn('map', response.data['tx'])
+        self.assertEqual(8, response.data['tx']['tile_size'])
+        game_id = response.data['tx']['game_id']
+        response = self.client.get('/api/v1/games/{}'.format(game_id))
+        self.assertEqual([0, 0, 8, 8], response.data['viewport'])
+        self.assertEqual(['X' * 8] * 8, response.data['map'])
+        response = self.client.put('/api/v1/games', {'game_id': game_id, 'x': 20, 'y': 20}, format='json')
+        self.assertIn('changes', response.data['tx'])
+
+
+class TestGameMarksView(TestCase, TestsCommonClient):
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def test_marks_until_win(self):
+        game = self.start_game(6, 4)
+        safe = [[x, y] for x in range(6) for y in range(6) if not game.board.is_mine(x, y)]
+        response = self.client.post('/api/v1/games/{}/marks'.format(game.pk), {'marks': safe}, format='json')
+        self.assertEqual(201, response.status_code)
+        result = response.data['tx']
+        self.assertEqual('win', result['status'])
+        self.assertEqual('win', result['marks'][-1]['status'])
+        stored = Game.objects.find_game_by_id(game.pk)
+        self.assertEqual((Game.WON, len(result['marks']), 32), (stored.status, stored.mark_count, stored.revealed_count))
+
+    def test_marks_stop_when_dead(self):
+        game = self.start_game(6, 4)
+        mine = next([x, y] for x in range(6) for y in range(6) if game.board.is_mine(x, y))
+        safe = next([x, y] for x in range(6) for y in range(6) if game.board.count(x, y) and not game.board.is_mine(x, y))
+        response = self.client.post('/api/v1/games/{}/marks?map=delta'.format(game.pk),
+                                    {'marks': [safe, mine, safe]}, format='json')
+        result = response.data['tx']
+        self.assertEqual(['clear', 'dead'], [mark['status'] for mark in result['marks']])
+        self.assertEqual(1, result['version'])
+        self.assertEqual(2, Game.objects.find_game_by_id(game.pk).mark_count)
+
+    def test_invalid_marks(self):
+        game = self.start_game()
+        response = self.client.post('/api/v1/games/{}/marks'.format(game.pk), {'marks': [[8, 0]]}, format='json')
+        self.assertEqual(412, response.status_code)
+        response = self.client.post('/api/v1/games/{}/marks'.format(game.pk), {'marks': []}, format='json')
+        self.assertEqual(412, response.status_code)
+
+
+class TestGamesBulkView(TestCase, TestsCommonClient):
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def post(self, data):
+        response = self.client.post('/api/v1/games/bulk', data, format='json')
+        return response, json.loads(b''.join(response.streaming_content).decode()) if response.streaming else None
+
+    @override_settings(GAME_BULK_BATCH_SIZE=2)
+    def test_games_are_streamed(self):
+        response, body = self.post({'size': 8, 'mines': 10, 'count': 5})
+        self.assertEqual(201, response.status_code)
+        pks = body['tx']['game_ids']
+        self.assertEqual(5, len(set(pks)))
+        games = Game.objects.filter(pk__in=pks)
+        self.assertEqual({(self.user.pk, 8, 10)}, set(games.values_list('user_id', 'size', 'mine_count')))
+        game = Game.objects.find_game_by_id(pks[0])
+        self.assertEqual(10, game.board.mine_count())
+        self.assertEqual(0, game.board.revealed_count())
+
+    def test_other_users_need_staff(self):
+        other, _ = UserCreation().create_user('', '', 'other', '', 'secret')
+        response, _ = self.post({'size': 8, 'mines': 10, 'count': 1, 'users': [other.pk]})
+        self.assertEqual(403, response.status_code)
+
+        self.user.is_staff = True
+        self.user.save()
+        response, body = self.post({'size': 8, 'mines': 10, 'count': 2, 'users': [other.pk, self.user.pk]})
+        users = dict(Game.objects.filter(pk__in=body['tx']['game_ids']).values_list('pk', 'user_id'))
+        self.assertEqual([other.pk, other.pk, self.user.pk, self.user.pk], [users[pk] for pk in body['tx']['game_ids']])
+
+    @override_settings(GAME_BULK_BATCH_SIZE=2)
+    def test_stream_is_timed(self):
+        observed = lambda: REQUEST_SECONDS.values.get(('bulk', 'post'), [0])[-1]
+        before = observed()
+        response = self.client.post('/api/v1/games/bulk', {'size': 8, 'mines': 10, 'count': 3}, format='json')
+        self.assertEqual(before, observed())
+        b''.join(response.streaming_content)
+        self.assertEqual(before + 1, observed())
+
+    @override_settings(GAME_BULK_BATCH_SIZE=2)
+    def test_failed_batch_ends_the_body(self):
+        create_many = Game.objects.create_many
+        calls = []
+
+        def fail_second(games):
+            calls.append(games)
+            if len(calls) == 2:
+                raise DatabaseError('insert failed')
+            return create_many(games)
+
+        with mock.patch.object(Game.objects, 'create_many', side_effect=fail_second), \
+                self.assertLogs('rest.views', 'ERROR'):
+            response, body = self.post({'size': 8, 'mines': 10, 'count': 5})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual('insert failed', body['error'])
+        self.assertEqual(sorted(body['tx']['game_ids']), sorted(Game.objects.values_list('pk', flat=True)))
+        self.assertEqual(2, len(body['tx']['game_ids']))
+
+    def test_first_batch_errors_are_not_streamed(self):
+        with mock.patch.object(Game.objects, 'create_many', side_effect=DatabaseError('insert failed')):
+            with self.assertRaises(DatabaseError):
+                self.post({'size': 8, 'mines': 10, 'count': 1})
+
+    def test_form_users(self):
+        self.user.is_staff = True
+        self.user.save()
+        others = [UserCreation().create_user('', '', 'other{}'.format(index), '', 'secret')[0] for index in range(2)]
+        response = self.client.post('/api/v1/games/bulk', 'size=8&mines=10&count=1&users={}&users={}'.format(
+            others[0].pk, others[1].pk), content_type='application/x-www-form-urlencoded')
+        pks = json.loads(b''.join(response.streaming_content).decode())['tx']['game_ids']
+        users = dict(Game.objects.filter(pk__in=pks).values_list('pk', 'user_id'))
+        self.assertEqual([other.pk for other in others], [users[pk] for pk in pks])
+
+    def test_users_must_be_a_list(self):
+        self.user.is_staff = True
+        self.user.save()
+        response, _ = self.post({'size': 8, 'mines': 10, 'count': 1, 'users': str(self.user.pk)})
+        self.assertEqual(412, response.status_code)
+
+    @override_settings(GAME_BULK_MAX_GAMES=10)
+    def test_invalid_parameters(self):
+        self.assertEqual(412, self.post({'size': 8, 'mines': 64, 'count': 1})[0].status_code)
+        self.assertEqual(412, self.post({'size': 8, 'mines': 10, 'count': 0})[0].status_code)
+        self.assertEqual(412, self.post({'size': 8, 'mines': 10, 'count': 11})[0].status_code)
+        self.assertEqual(0, Game.objects.count())
+
+
+class TestCachedTokenAuthentication(TestCase, TestsCommonClient):
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def mark(self, game):
+        x, y = self.safe_cell(game)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.put('/api/v1/games', {'game_id': game.pk, 'x': x, 'y': y}, format='json')
+        return response, [query['sql'] for query in queries if 'authtoken_token' in query['sql']]
+
+    def test_tokens_are_looked_up_once(self):
+        game = self.start_game()
+        response, auth_queries = self.mark(game)
+        self.assertEqual(201, response.status_code)
+        self.assertEqual([], auth_queries)
+
+    def test_deleted_token_is_forgotten(self):
+        game = self.start_game()
+        Token.objects.filter(user=self.user).delete()
+        self.assertEqual(401, self.mark(game)[0].status_code)
+
+    def test_inactive_user_is_forgotten(self):
+        game = self.start_game()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(401, self.mark(game)[0].status_code)
+
+    def test_logins_keep_tokens(self):
+        game = self.start_game()
+        self.user.save(update_fields=['last_login'])
+        self.assertEqual([], self.mark(game)[1])
+
+    def test_evicted_tokens_leave_the_user_index(self):
+        cache = TokenCache(1, 60)
+        other = User.objects.create(username='other')
+        cache.store('first', self.user, None)
+        cache.store('second', other, None)
+        self.assertEqual({other.pk: {'second'}}, cache.user_keys)
+        cache.invalidate_user(other.pk)
+        self.assertEqual(({}, None), (cache.user_keys, cache.get('second')))
+
+
+class TestServerTiming(TestCase, TestsCommonClient):
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def test_disabled_by_default(self):
+        game = self.start_game()
+        response = self.client.get('/api/v1/games/{}'.format(game.pk))
+        self.assertNotIn('Server-Timing', response)
+
+    @override_settings(SERVER_TIMING=True)
+    def test_mark_timings(self):
+        game = self.start_game()
+        x, y = self.safe_cell(game)
+        with self.assertLogs('rest.middleware', 'INFO') as logs:
+            response = self.client.put('/api/v1/games', {'game_id': game.pk, 'x': x, 'y': y}, format='json')
+        metrics = [metric.split(';')[0] for metric in response['Server-Timing'].split(', ')]
+        self.assertEqual(['db', 'lock', 'reveal', 'save', 'map', 'total'], metrics)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(('PUT', 201), (line['method'], line['status']))
+        self.assertGreater(line['queries'], 0)
+
+    @override_settings(SERVER_TIMING=True, GAME_BULK_BATCH_SIZE=1)
+    def test_streams_are_logged_once_sent(self):
+        with self.assertLogs('rest.middleware', 'INFO') as logs, CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/v1/games/bulk', {'size': 8, 'mines': 10, 'count': 3}, format='json')
+            self.assertEqual([], logs.records)
+            b''.join(response.streaming_content)
+        self.assertNotIn('Server-Timing', response)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(('POST', 201, len(queries)), (line['method'], line['status'], line['queries']))
+
+
+class TestMetricsView(TestCase, TestsCommonClient):
+
+    def setUp(self) -> None:
+        self.generate()
+
+    def test_game_metrics(self):
+        game = self.start_game()
+        x, y = self.safe_cell(game)
+        self.client.put('/api/v1/games', {'game_id': game.pk, 'x': x, 'y': y}, format='json')
+        response = self.client.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        for name in ('minesweeper_games_started_total ', 'minesweeper_mark_seconds_count{outcome=',
+                     'minesweeper_board_size_bucket{le="10"}', 'minesweeper_revealed_cells_sum ',
+                     'minesweeper_request_seconds_count{view="games",method="put"}',
+                     'minesweeper_board_cache_events_total{event="hits"}'):
+            self.assertIn(name, body)
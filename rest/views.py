@@ -1,31 +1,48 @@
+import json
+import logging
+
 import coreapi
 import coreschema
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse, QueryDict
 from django.shortcuts import render
+from django.utils.cache import get_conditional_response, patch_cache_control
 from rest_framework import status, renderers
-from rest_framework.authentication import TokenAuthentication
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import ValidationError, PermissionDenied
 from rest_framework.generics import CreateAPIView
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 from django.contrib.auth import get_user_model
+from django.views import View
 
 # Create your views here.
 from rest_framework.viewsets import ModelViewSet
 from rest_framework_swagger.renderers import SwaggerUIRenderer, OpenAPIRenderer
 
 from games.game import RandomGameStarter, GameInformationService, InvalidSizeParameterException, \
-    InvalidMinesParameterException, GameInteractor
+    InvalidMinesParameterException, GameInteractor, InvalidMarkParameterException, GameIsNotActiveException, \
+    InvalidCountParameterException
+from games import timing
+from games.metrics import registry, timed, REQUEST_SECONDS
 from games.models import Game
+from rest.authentication import CachedTokenAuthentication
+from rest.renderers import RunLengthBoardRenderer, BinaryBoardRenderer
 from rest.schemas import CustomSchema
 from rest.serializers import UserSerializer
 
+logger = logging.getLogger(__name__)
+
+# Finished games never change, clients and proxies can keep them for a year
+FINISHED_GAME_MAX_AGE = 365 * 24 * 60 * 60
+
 
 class GamesView(APIView):
     """ Game service """
 
-    authentication_classes = [TokenAuthentication ]
+    authentication_classes = [CachedTokenAuthentication ]
     permission_classes = [AllowAny ]
     game_starter_service = RandomGameStarter()
     game_marker = GameInteractor()
@@ -54,10 +71,16 @@ class GamesView(APIView):
                           required=True,
                           description="Position in y starting with 0",
                           schema=coreschema.Integer(0)),
+            coreapi.Field('map',
+                          required=False,
+                          location='query',
+                          description="Use delta to get only the cells changed by this mark and the board version",
+                          schema=coreschema.String()),
         ]
     )
 
 
+    @timed(REQUEST_SECONDS, view='games')
     def post(self, request):
         """
         Starts a new game
@@ -70,10 +93,14 @@ class GamesView(APIView):
             data = request.data
             game_information = self.game_starter_service.start_game(int(data.get('size')), int(data.get('mines')), request.user)
             information = {
-                'map': game_information.notrevealed_matrix_string,
                 'game_id': game_information.pk,
                 'mine_count': game_information.mine_count,
             }
+            # Tiled games are too big for a whole map, they are looked at through viewports
+            if game_information.is_tiled:
+                information['tile_size'] = game_information.gamemodel.tile_size
+            else:
+                information['map'] = game_information.notrevealed_matrix_string
             return Response(
                 {'message': "Game started", 'tx': information},
                 status=status.HTTP_201_CREATED)
@@ -86,6 +113,7 @@ class GamesView(APIView):
         except ValueError as ve:
             return Response({'messages': {str(ve)}}, status.HTTP_401_UNAUTHORIZED)
 
+    @timed(REQUEST_SECONDS, view='games')
     def put(self, request):
         """
         Marks a position in a game
@@ -94,11 +122,15 @@ class GamesView(APIView):
         - game_id is id of existing and active game
         - x is lesser than game size
         - y is lesser than game size
+
+        With map=delta as query parameter only the cells revealed by the mark are returned,
+        as [x, y, symbol] changes, together with the board version
         """
         try:
             data = request.data
+            delta = request.query_params.get('map') == 'delta'
             game = self.game_manager.find_game_by_id(request.data.get('game_id'))
-            result = self.game_marker.mark(GameInformationService(game), int(data.get('x')), int(data.get('y')))
+            result = self.game_marker.mark(GameInformationService(game), int(data.get('x')), int(data.get('y')), delta)
             return Response(
                 {'message': "Game marked", 'tx': result},
                 status=status.HTTP_201_CREATED)
@@ -108,22 +140,252 @@ class GamesView(APIView):
             return Response({'messages': {str(ve)}}, status.HTTP_412_PRECONDITION_FAILED)
         except InvalidMinesParameterException as ve:
             return Response({'messages': {str(ve)}}, status.HTTP_412_PRECONDITION_FAILED)
+        except InvalidMarkParameterException as ve:
+            return Response({'messages': {str(ve)}}, status.HTTP_412_PRECONDITION_FAILED)
+        except (GameIsNotActiveException, Game.DoesNotExist) as ge:
+            return Response({'messages': {str(ge)}}, status.HTTP_412_PRECONDITION_FAILED)
+
+
+class GamesBulkView(APIView):
+    """ Many games started at once, for tournaments and load tests """
+
+    authentication_classes = [CachedTokenAuthentication ]
+    permission_classes = [IsAuthenticated ]
+    game_starter_service = RandomGameStarter()
+    user_manager = get_user_model().objects
+
+    schema = CustomSchema(fields_post=[
+        coreapi.Field('size',
+                      required=True,
+                      description="Size of every map",
+                      schema=coreschema.Integer(5)),
+        coreapi.Field('mines',
+                      required=True,
+                      description="Amount of mines of every map",
+                      schema=coreschema.Integer(1)),
+        coreapi.Field('count',
+                      required=True,
+                      description="Games started for each user",
+                      schema=coreschema.Integer(1)),
+        coreapi.Field('users',
+                      required=False,
+                      description="Ids of the users to start games for, staff only. The caller by default",
+                      schema=coreschema.Array(items=coreschema.Integer())),
+    ])
+
+    @timed(REQUEST_SECONDS, view='bulk')
+    def post(self, request):
+        """
+        Starts count games for the caller or for each of the given users
+
+        Games are written in batches and their ids are streamed back as every batch is saved,
+        in the order of the users. The first batch is saved before answering, when a later one
+        fails the body ends with an error and the ids already streamed are the games started
+
+        Precondition:
+        - size and mines are valid for a single game
+        - count is an integer bigger than zero, count times the users is at most GAME_BULK_MAX_GAMES
+        """
+        try:
+            data = request.data
+            users = self.users(request)
+            count = int(data['count'])
+            max_games = getattr(settings, 'GAME_BULK_MAX_GAMES', 100000)
+            if count * len(users) > max_games:
+                raise InvalidCountParameterException("At most {} games can be started at once".format(max_games))
+            batches = self.game_starter_service.start_games(int(data['size']), int(data['mines']), users, count,
+                                                            getattr(settings, 'GAME_BULK_BATCH_SIZE', 1000))
+            first = next(batches)
+        except KeyError as ke:
+            return Response({'messages': str(ke)}, status.HTTP_412_PRECONDITION_FAILED)
+        except (TypeError, ValueError) as ve:
+            return Response({'messages': {str(ve)}}, status.HTTP_412_PRECONDITION_FAILED)
+        except (InvalidSizeParameterException, InvalidMinesParameterException, InvalidCountParameterException) as ve:
+            return Response({'messages': {str(ve)}}, status.HTTP_412_PRECONDITION_FAILED)
+        return StreamingHttpResponse(self.stream(first, batches), status=status.HTTP_201_CREATED,
+                                     content_type='application/json')
+
+    # Form bodies repeat the users key, json bodies give a list
+    def users(self, request):
+        data = request.data
+        if 'users' not in data:
+            return [request.user]
+        if not request.user.is_staff:
+            raise PermissionDenied("Only staff can start games for other users")
+        pks = data.getlist('users') if isinstance(data, QueryDict) else data['users']
+        if not isinstance(pks, list):
+            raise ValueError("Users must be a list of user ids")
+        pks = [int(pk) for pk in pks]
+        users = self.user_manager.in_bulk(pks)
+        missing = [pk for pk in pks if pk not in users]
+        if missing:
+            raise ValueError("Users {} do not exist".format(missing))
+        return [users[pk] for pk in pks]
+
+    # Same body as the other views, written a batch of ids at a time. The status is already sent
+    # when a batch fails, the error is the last key of the body
+    def stream(self, first, batches):
+        yield '{"message": "Games started", "tx": {"game_ids": [' + ', '.join(str(pk) for pk in first)
+        try:
+            for pks in batches:
+                yield ', ' + ', '.join(str(pk) for pk in pks)
+        except Exception as error:
+            logger.exception('Bulk game creation failed')
+            yield ']}, "error": ' + json.dumps(str(error)) + '}'
+            return
+        yield ']}}'
+
+
+class GameMarksView(APIView):
+    """ Batch of marks on a game """
+
+    authentication_classes = [CachedTokenAuthentication ]
+    permission_classes = [AllowAny ]
+    game_marker = GameInteractor()
+    game_manager = Game.objects
+
+    schema = CustomSchema(fields_post=[
+        coreapi.Field('marks',
+                      required=True,
+                      description="Ordered list of [x, y] positions to mark",
+                      schema=coreschema.Array(items=coreschema.Array(items=coreschema.Integer()))),
+        coreapi.Field('map',
+                      required=False,
+                      location='query',
+                      description="Use delta to get only the cells changed by the marks and the board version",
+                      schema=coreschema.String()),
+    ])
+
+    @timed(REQUEST_SECONDS, view='marks')
+    def post(self, request, game_id):
+        """
+        Applies many marks on a game in order, in a single transaction
+
+        Marking stops at the first mark that ends the game. Returns the status of every applied
+        mark and a single map, or with map=delta the changes of all of them
+
+        Precondition:
+        - game_id is id of existing and active game
+        - marks is a non empty list of [x, y] pairs lesser than game size
+        """
+        try:
+            delta = request.query_params.get('map') == 'delta'
+            moves = [(int(x), int(y)) for x, y in request.data['marks']]
+            game = self.game_manager.find_game_by_id(game_id)
+            result = self.game_marker.mark_many(GameInformationService(game), moves, delta)
+            return Response(
+                {'message': "Game marked", 'tx': result},
+                status=status.HTTP_201_CREATED)
+        except KeyError as ke:
+            return Response({'messages': str(ke)}, status.HTTP_412_PRECONDITION_FAILED)
+        except (TypeError, ValueError) as ve:
+            return Response({'messages': {str(ve)}}, status.HTTP_412_PRECONDITION_FAILED)
+        except InvalidMarkParameterException as ve:
+            return Response({'messages': {str(ve)}}, status.HTTP_412_PRECONDITION_FAILED)
+        except GameIsNotActiveException as ge:
+            return Response({'messages': {str(ge)}}, status.HTTP_412_PRECONDITION_FAILED)
 
 
 class GameInteractionView(APIView):
     game_manager = Game.objects
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [RunLengthBoardRenderer, BinaryBoardRenderer]
 
+    schema = CustomSchema(fields_get=[
+        coreapi.Field('game_id',
+                      required=True,
+                      location='path',
+                      description="Game id",
+                      schema=coreschema.Integer()),
+        coreapi.Field('viewport',
+                      required=False,
+                      location='query',
+                      description="x0,y0,w,h to get only h rows from x0 and w columns from y0 of the map",
+                      schema=coreschema.String()),
+    ])
+
+    @timed(REQUEST_SECONDS, view='game')
     def get(self, request, game_id):
         """
         Retrieves a game by id
+
+        The map is json by default, with Accept application/vnd.minesweeper.rle+json (or format=rle)
+        rows are run length encoded and with Accept application/vnd.minesweeper.board (or format=board)
+        a packed binary frame with 4 bits per cell is returned
+
+        With viewport=x0,y0,w,h only that rectangle of the map is returned, tiled games without it
+        get their first tile
+
+        Responses carry an ETag with the board version, If-None-Match with it gets 304 Not Modified.
+        Finished games show the whole revealed map and can be cached forever
         """
         game_model = self.game_manager.find_game_by_id(game_id)
         game_information = GameInformationService(game_model)
+        try:
+            viewport = self.viewport(request, game_information)
+        except ValueError as ve:
+            return Response({'messages': {str(ve)}}, status.HTTP_412_PRECONDITION_FAILED)
+        etag = '"{}-{}-{}{}"'.format(game_information.pk, game_information.version, request.accepted_renderer.format,
+                                     '-' + ','.join(map(str, viewport)) if viewport else '')
+        finished = not game_information.is_active
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return self.cacheable(not_modified, etag, finished)
+
         information = {
-            'map': game_information.notrevealed_matrix_string,
             'mine_count': game_information.mine_count,
+            'revealed_count': game_information.revealed_count,
+            'mark_count': game_information.mark_count,
+            'status': game_information.status,
+            'version': game_information.version,
         }
-        return Response(information, status=status.HTTP_200_OK)
+        board = game_information.final_board if finished else game_information.board
+        if viewport:
+            x0, y0, width, height = viewport
+            board = board.window(x0, y0, height, width)
+            information['viewport'] = viewport
+        if getattr(request.accepted_renderer, 'renders_board', False):
+            information['board'] = board
+            information['revealed'] = finished
+        else:
+            with timing.span('map'):
+                information['map'] = board.symbol_rows() if finished else board.player_rows()
+
+        return self.cacheable(Response(information, status=status.HTTP_200_OK), etag, finished)
+
+    # 304 responses carry the same caching headers as the response they stand for
+    @staticmethod
+    def cacheable(response, etag, finished):
+        response['ETag'] = etag
+        if finished:
+            patch_cache_control(response, public=True, max_age=FINISHED_GAME_MAX_AGE, immutable=True)
+        else:
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    # [x0, y0, w, h] clipped to the map, or None for the whole map
+    def viewport(self, request, game):
+        value = request.query_params.get('viewport')
+        if value is None:
+            if not game.is_tiled:
+                return None
+            side = min(game.size, game.gamemodel.tile_size)
+            return [0, 0, side, side]
+
+        x0, y0, width, height = (int(part) for part in value.split(','))
+        if not (0 <= x0 < game.size and 0 <= y0 < game.size and width > 0 and height > 0):
+            raise ValueError("Viewport {} is out of a map of size {}".format(value, game.size))
+        width, height = min(width, game.size - y0), min(height, game.size - x0)
+        max_cells = getattr(settings, 'GAME_VIEWPORT_MAX_CELLS', 1000000)
+        if width * height > max_cells:
+            raise ValueError("Viewport {} has more than {} cells".format(value, max_cells))
+        return [x0, y0, width, height]
+
+
+class MetricsView(View):
+    """ Game engine metrics in the prometheus text format """
+
+    def get(self, request):
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 class UsersView(CreateAPIView):